@@ -2,15 +2,25 @@
 """
 provides persistence to zeromq.
 """
+import bisect
 import contextlib
 import copy
+import os
 import pathlib
+import struct
 import threading
 import time
-from typing import List, Optional, Callable, Union  # pylint: disable=unused-import
+from typing import Any, Iterator, List, Optional, Callable, Sequence, Tuple, Union  # pylint: disable=unused-import
 
 import zmq
 
+import persizmq.codec
+import persizmq.metrics
+
+# maximum number of messages drained from the socket at once in the conflating mode, so that a publisher faster than
+# the subscriber can not postpone the delivery indefinitely
+_MAX_CONFLATED = 1024
+
 
 class ThreadedSubscriber:
     """
@@ -22,15 +32,29 @@ class ThreadedSubscriber:
 
     # pylint: disable=too-many-instance-attributes
 
-    def __init__(self, subscriber: zmq.Socket, callback: Callable[[bytes], None],
-                 on_exception: Callable[[Exception], None]) -> None:
+    def __init__(self,
+                 subscriber: zmq.Socket,
+                 callback: Callable[[Any], None],
+                 on_exception: Callable[[Exception], None],
+                 metrics: Optional[persizmq.metrics.Metrics] = None,
+                 codec: Optional[persizmq.codec.Codec] = None,
+                 conflate: bool = False) -> None:
         """
         :param subscriber: zeromq subscriber socket; only operated by ThreadedSubscriber, do not share among threads!
         :param callback:
             This function is called every time a message is received. Can be accessed and changed later
             through ThreadedSubscriber.callback
         :param on_exception: Is called when an exception occurs during the callback call.
+        :param metrics: if set, counts the received messages and marks their reception time
+        :param codec:
+            if set, the callback is given the decoded messages instead of bytes. Leave it unset if the callback
+            is a storage; set the codec on the storage instead so that the messages are decoded lazily.
+        :param conflate:
+            if set, all the pending messages are drained from the socket and only the latest one is passed on to
+            the callback. Use it with PersistentLatestStorage so that a burst of messages results in a single write.
+            For single-part messages, you can additionally set zmq.CONFLATE on the socket before connecting it.
         """
+        # pylint: disable=too-many-arguments
 
         if isinstance(subscriber, zmq.Socket):
             self._subscriber = subscriber
@@ -40,6 +64,9 @@ class ThreadedSubscriber:
         self.callback = callback
         self.on_expection = on_exception
         self.operational = False
+        self.metrics = metrics
+        self.codec = codec
+        self.conflate = conflate
 
         self._exit_stack = contextlib.ExitStack()
 
@@ -70,6 +97,28 @@ class ThreadedSubscriber:
             self._exit_stack.close()
             raise init_err  # pylint: disable=raising-bad-type
 
+    def _conflate(self, msg: bytes) -> bytes:
+        """
+        drains the pending messages from the socket.
+
+        :param msg: message received last
+        :return: latest pending message, or msg if no message is pending
+        """
+        conflated = 0
+        while conflated < _MAX_CONFLATED:
+            try:
+                msg = self._subscriber.recv(zmq.NOBLOCK)  # pylint: disable=no-member
+            except zmq.Again:
+                break
+
+            conflated += 1
+
+        if conflated > 0 and self.metrics is not None:
+            self.metrics.increment(name=persizmq.metrics.RECEIVED, amount=conflated)
+            self.metrics.increment(name=persizmq.metrics.CONFLATED, amount=conflated)
+
+        return msg
+
     def _listen(self) -> None:
         """
         listens on the zeromq subscriber. This function is expected to run in a separate thread.
@@ -95,7 +144,17 @@ class ThreadedSubscriber:
 
                     if self._subscriber in socks and socks[self._subscriber] == zmq.POLLIN:
                         msg = self._subscriber.recv()
-                        self.callback(msg)
+
+                        if self.conflate:
+                            msg = self._conflate(msg=msg)
+
+                        if self.metrics is not None:
+                            self.metrics.mark_received()
+
+                        if self.codec is None:
+                            self.callback(msg)
+                        else:
+                            self.callback(self.codec.decode(msg))
                 except Exception as err:  # pylint: disable=broad-except
                     self.on_expection(err)
                     break
@@ -121,12 +180,250 @@ class ThreadedSubscriber:
             self.shutdown()
 
 
+def _to_path(persistent_dir: Union[str, pathlib.Path]) -> pathlib.Path:
+    """
+    :param persistent_dir: directory given by the user
+    :return: directory as a path
+    """
+    if isinstance(persistent_dir, str):
+        return pathlib.Path(persistent_dir)
+
+    if isinstance(persistent_dir, pathlib.Path):
+        return persistent_dir
+
+    raise TypeError("unexpected type of argument persistent_dir: {}".format(persistent_dir.__class__.__name__))
+
+
+def _message_path(persistent_dir: pathlib.Path, index: int) -> pathlib.Path:
+    """
+    :param persistent_dir: directory of the messages
+    :param index: sequence number of the message
+    :return: path to the message file
+    """
+    # Make sure the files can be sorted as strings (which breaks if you have files=[3.bin, 21.bin])
+    return persistent_dir / "{:030d}.bin".format(index)
+
+
+def _recover_messages(persistent_dir: pathlib.Path) -> Tuple[List[pathlib.Path], int]:
+    """
+    lists the messages persisted in the directory and removes the left-over temporary files.
+
+    :param persistent_dir: directory of the messages
+    :return: sorted paths to the message files, sequence number of the next message
+    """
+    paths = []  # type: List[pathlib.Path]
+    count = 0
+
+    files = sorted(list(persistent_dir.iterdir()))
+    for path in files:
+        if path.suffix == ".bin":
+            paths.append(path)
+        elif path.suffix == ".tmp":
+            path.unlink()
+
+    if paths:
+        stem = paths[-1].stem
+        value_err = None  # type: Optional[ValueError]
+        try:
+            count = int(stem) + 1
+        except ValueError as err:
+            value_err = err
+
+        if value_err is not None:
+            raise ValueError("Failed to reinitialize from the file {!r}. Please make sure nobody else writes files "
+                             "to the persistent directory.".format(paths[-1]))
+
+    return paths, count
+
+
+def _write_atomically(path: pathlib.Path, data: bytes, mtime: Optional[float] = None) -> None:
+    """
+    writes the data to a temporary file and renames it to the path so that the file is never observed half-written.
+
+    :param path: to the file
+    :param data: content of the file
+    :param mtime: if set, the modification time of the file is set to this timestamp
+    """
+    tmp_pth = path.parent / (path.name + ".tmp")  # type: Optional[pathlib.Path]
+
+    try:
+        assert tmp_pth is not None, "Unexpected tmp_pth None; expected it to be initialized just before."
+        tmp_pth.write_bytes(data)
+        if mtime is not None:
+            os.utime(tmp_pth.as_posix(), (mtime, mtime))
+        tmp_pth.rename(path)
+        tmp_pth = None
+
+    finally:
+        if tmp_pth is not None and tmp_pth.exists():  # type: ignore
+            tmp_pth.unlink()  # type: ignore
+
+
+def _mark_filtered(metrics: Optional[persizmq.metrics.Metrics]) -> None:
+    """
+    marks that a filter rejected the message given to a storage.
+
+    :param metrics: if set, records the filtered message
+    """
+    if metrics is not None:
+        metrics.mark_filtered()
+
+
+def _write_message(persistent_dir: pathlib.Path, index: int, msg: bytes,
+                   metrics: Optional[persizmq.metrics.Metrics]) -> pathlib.Path:
+    """
+    writes the message file atomically and marks the message as persisted in the metrics.
+
+    :param persistent_dir: directory of the messages
+    :param index: sequence number of the message
+    :param msg: message to be written
+    :param metrics: if set, records the persisted message
+    :return: path to the message file
+    """
+    start = time.monotonic() if metrics is not None else 0.0
+
+    pth = _message_path(persistent_dir=persistent_dir, index=index)
+    _write_atomically(path=pth, data=msg)
+
+    if metrics is not None:
+        metrics.mark_persisted(write_duration=time.monotonic() - start)
+
+    return pth
+
+
+class _TimeIndex:
+    """
+    keeps a sparse on-disk index of the receive timestamps.
+
+    An entry (sequence number, timestamp) is appended to the index file every interval messages. Since the messages
+    are added in the order of their timestamps, all the messages before an entry were received at or before
+    the entry's timestamp, so a lookup needs to scan at most interval messages before it hits the requested time.
+    """
+
+    _ENTRY_FORMAT = "<Qd"
+    _ENTRY_SIZE = struct.calcsize(_ENTRY_FORMAT)
+
+    def __init__(self, path: pathlib.Path, interval: int, first_index: Optional[int], count: int) -> None:
+        """
+        :param path: to the index file
+        :param interval: number of messages between two entries
+        :param first_index: sequence number of the oldest retained message, or None if no message is retained
+        :param count: sequence number of the next message as recovered from the message files
+        """
+        if interval <= 0:
+            raise ValueError("Expected a positive index interval, got: {}".format(interval))
+
+        self.path = path
+        self.interval = interval
+
+        self.__indices = []  # type: List[int]
+        self.__timestamps = []  # type: List[float]
+
+        # number of entries dropped from memory, but not yet from the file
+        self.__dropped = 0
+
+        if self.path.exists():
+            data = self.path.read_bytes()
+
+            # A crash might have left a partially written entry at the end of the file.
+            usable = len(data) - len(data) % _TimeIndex._ENTRY_SIZE
+            for index, timestamp in struct.iter_unpack(_TimeIndex._ENTRY_FORMAT, data[:usable]):
+                self.__indices.append(index)
+                self.__timestamps.append(timestamp)
+
+            if usable != len(data):
+                self.__rewrite()
+
+        # Once all the messages have been consumed, no message file is left to recover the sequence numbers from,
+        # but the index may still hold the entries of the consumed messages. Continue the sequence after them so that
+        # it never goes backwards and the stale entries are dropped.
+        self.next_index = max(count, self.__indices[-1] + 1) if self.__indices else count
+
+        self.drop_before(first_index=self.next_index if first_index is None else first_index)
+        if self.__dropped > 0:
+            self.__rewrite()
+
+    def __rewrite(self) -> None:
+        """
+        rewrites the index file with the entries kept in memory.
+        """
+        _write_atomically(
+            path=self.path,
+            data=b''.join(
+                struct.pack(_TimeIndex._ENTRY_FORMAT, index, timestamp)
+                for index, timestamp in zip(self.__indices, self.__timestamps)))
+        self.__dropped = 0
+
+    def add(self, index: int, timestamp: float) -> None:
+        """
+        records the timestamp of a newly added message if an entry is due.
+
+        :param index: sequence number of the message
+        :param timestamp: receive timestamp of the message
+        """
+        if self.__indices and index - self.__indices[-1] < self.interval:
+            return
+
+        self.__indices.append(index)
+        self.__timestamps.append(timestamp)
+        with self.path.open("ab") as fid:
+            fid.write(struct.pack(_TimeIndex._ENTRY_FORMAT, index, timestamp))
+
+    def drop_before(self, first_index: int) -> None:
+        """
+        drops the entries of the removed messages. The index file is compacted once the dropped entries outnumber
+        the remaining ones, so the compaction is amortized over the removals.
+
+        :param first_index: sequence number of the oldest retained message
+        """
+        if not self.__indices or self.__indices[0] >= first_index:
+            return
+
+        count = bisect.bisect_left(self.__indices, first_index)
+        del self.__indices[:count]
+        del self.__timestamps[:count]
+        self.__dropped += count
+
+        if self.__dropped >= max(len(self.__indices), 64):
+            self.__rewrite()
+
+    def lower_bound(self, timestamp: float) -> Optional[int]:
+        """
+        :param timestamp: receive timestamp
+        :return: sequence number of the last indexed message received before the timestamp, if any
+        """
+        position = bisect.bisect_left(self.__timestamps, timestamp)
+        if position == 0:
+            return None
+
+        return self.__indices[position - 1]
+
+
 class PersistentStorage:
     """
     persists received messages on disk.
+
+    The modification time of each message file is set to the time when the message has been added. Together with
+    a sparse time index this allows for seeking and replaying the retained messages by the receive time.
+
+    The receive times are clamped so that they never decrease, even if the system clock is set back. They are only
+    as precise as the file system's modification times (e.g., 2 seconds on FAT) and are lost if the directory is
+    copied without preserving the modification times (e.g., cp without -p).
     """
 
-    def __init__(self, persistent_dir: Union[str, pathlib.Path]) -> None:
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self,
+                 persistent_dir: Union[str, pathlib.Path],
+                 metrics: Optional[persizmq.metrics.Metrics] = None,
+                 codec: Optional[persizmq.codec.Codec] = None,
+                 index_interval: int = 64) -> None:
+        """
+        :param persistent_dir: directory where the messages are stored
+        :param metrics: if set, counts the filtered, persisted and popped messages and records the latencies
+        :param codec: if set, enables front_object and add_object
+        :param index_interval: number of messages between two entries of the time index
+        """
         if isinstance(persistent_dir, str):
             self.__persistent_dir = pathlib.Path(persistent_dir)
         elif isinstance(persistent_dir, pathlib.Path):
@@ -142,28 +439,58 @@ class PersistentStorage:
         self.__paths = []  # type: List[pathlib.Path]
         self.__count = 0  # To count messages and name them, so that naming conflicts can be avoided.
 
-        files = sorted(list(self.__persistent_dir.iterdir()))
-        for path in files:
-            if path.suffix == ".bin":
-                self.__paths.append(path)
-            elif path.suffix == ".tmp":
-                path.unlink()
+        # Sizes and receive times of the pending messages, aligned with __paths, for the retention.
+        self.__sizes = []  # type: List[int]
+        self.__timestamps = []  # type: List[float]
+        self.__total_bytes = 0
 
-        if self.__paths:
-            stem = self.__paths[-1].stem
-            value_err = None  # type: Optional[ValueError]
-            try:
-                self.__count = int(stem) + 1
-            except ValueError as err:
-                value_err = err
+        # receive time of the last added message; the receive times never decrease
+        self.__last_timestamp = 0.0
+
+        self.__codec = codec
+        # The first message is decoded at most once and the decoded object is cached until it is popped.
+        self.__first_decoded = None  # type: Any
+        self.__first_is_decoded = False
+
+        self.__metrics = metrics
+        # Monotonic persistence times of the messages, only tracked if metrics are set; None for recovered messages.
+        self.__persisted_at = []  # type: List[Optional[float]]
+
+        self.__paths, self.__count = _recover_messages(persistent_dir=self.__persistent_dir)
+
+        for pth in self.__paths:
+            stat = pth.stat()
+            self.__sizes.append(stat.st_size)
+
+            # The modification times of the recovered files might be out of order on a coarse file system.
+            self.__last_timestamp = max(self.__last_timestamp, stat.st_mtime)
+            self.__timestamps.append(self.__last_timestamp)
+        self.__total_bytes = sum(self.__sizes)
 
-            if value_err is not None:
-                raise ValueError("Failed to reinitialize from the file {!r}. Please make sure nobody else writes files "
-                                 "to the persistent directory.".format(self.__paths[-1]))
+        self.__time_index = _TimeIndex(
+            path=self.__persistent_dir / "timestamps.index",
+            interval=index_interval,
+            first_index=int(self.__paths[0].stem) if self.__paths else None,
+            count=self.__count)
+        self.__count = self.__time_index.next_index
 
+        if self.__paths:
             pth = self.__paths[0]
             self.__first = pth.read_bytes()
 
+        if self.__metrics is not None:
+            self.__persisted_at = [None] * len(self.__paths)
+            self.__metrics.set_gauge(name=persizmq.metrics.QUEUE_DEPTH, value=len(self.__paths))
+
+    def __first_index(self) -> int:
+        """
+        :return: sequence number of the first pending message, or of the next message if the queue is empty
+        """
+        if self.__paths:
+            return int(self.__paths[0].stem)
+
+        return self.__count
+
     def front(self) -> Optional[bytes]:
         """
         makes a copy of the first pending message, but does not remove it from the persistent storage's
@@ -178,6 +505,27 @@ class PersistentStorage:
             msg = copy.deepcopy(self.__first)
             return msg
 
+    def front_object(self) -> Any:
+        """
+        decodes the first pending message with the codec, but does not remove it from the persistent storage's
+        internal queue. The message is decoded only once; the subsequent calls return the same object, so do not
+        modify it.
+
+        :return: decoded first message, or None if no message in the queue
+        """
+        if self.__codec is None:
+            raise ValueError("No codec has been specified for the persistent storage.")
+
+        with self.__mu:  # pylint: disable=not-context-manager
+            if self.__first is None:
+                return None
+
+            if not self.__first_is_decoded:
+                self.__first_decoded = self.__codec.decode(self.__first)
+                self.__first_is_decoded = True
+
+            return self.__first_decoded
+
     def pop_front(self) -> bool:
         """
         removes a message from the persistent storage's internal queue.
@@ -191,6 +539,22 @@ class PersistentStorage:
             pth = self.__paths.pop(0)
             pth.unlink()
 
+            self.__total_bytes -= self.__sizes.pop(0)
+            self.__timestamps.pop(0)
+
+            self.__time_index.drop_before(first_index=self.__first_index())
+
+            if self.__metrics is not None:
+                persisted_at = self.__persisted_at.pop(0)
+                if persisted_at is not None:
+                    self.__metrics.observe(
+                        name=persizmq.metrics.PERSIST_TO_CONSUME, seconds=time.monotonic() - persisted_at)
+                self.__metrics.increment(name=persizmq.metrics.POPPED)
+                self.__metrics.set_gauge(name=persizmq.metrics.QUEUE_DEPTH, value=len(self.__paths))
+
+            self.__first_decoded = None
+            self.__first_is_decoded = False
+
             if not self.__paths:
                 self.__first = None
             else:
@@ -198,6 +562,36 @@ class PersistentStorage:
                 self.__first = pth.read_bytes()
             return True
 
+    def __add(self, msg: bytes) -> None:
+        """
+        writes the message and appends it to the internal queue. Expects the caller to hold the lock.
+
+        :param msg: message to be added
+        """
+        start = time.monotonic() if self.__metrics is not None else 0.0
+        timestamp = max(time.time(), self.__last_timestamp)
+        self.__last_timestamp = timestamp
+
+        pth = _message_path(persistent_dir=self.__persistent_dir, index=self.__count)
+        _write_atomically(path=pth, data=msg, mtime=timestamp)
+
+        self.__time_index.add(index=self.__count, timestamp=timestamp)
+
+        self.__paths.append(pth)
+        self.__sizes.append(len(msg))
+        self.__timestamps.append(timestamp)
+        self.__total_bytes += len(msg)
+        self.__count += 1
+
+        if self.__first is None:
+            self.__first = msg
+
+        if self.__metrics is not None:
+            end = time.monotonic()
+            self.__persisted_at.append(end)
+            self.__metrics.mark_persisted(write_duration=end - start)
+            self.__metrics.set_gauge(name=persizmq.metrics.QUEUE_DEPTH, value=len(self.__paths))
+
     def add_message(self, msg: Optional[bytes]) -> None:
         """
         adds a message to the persistent storage's internal queue.
@@ -205,29 +599,172 @@ class PersistentStorage:
         :param msg: message to be added
         """
         if msg is None:
+            if self.__metrics is not None:
+                self.__metrics.mark_filtered()
             return
 
         with self.__mu:  # pylint: disable=not-context-manager
+            self.__add(msg=msg)
 
-            # Make sure the files can be sorted as strings (which breaks if you have files=[3.bin, 21.bin])
-            pth = self.__persistent_dir / "{:030d}.bin".format(self.__count)
-            tmp_pth = pth.parent / (pth.name + ".tmp")  # type: Optional[pathlib.Path]
+    def add_messages(self, msgs: Sequence[Optional[bytes]]) -> None:
+        """
+        adds a batch of messages to the persistent storage's internal queue. The lock is acquired only once for
+        the whole batch.
+
+        :param msgs: messages to be added in order; None entries are skipped
+        """
+        with self.__mu:  # pylint: disable=not-context-manager
+            for msg in msgs:
+                if msg is None:
+                    if self.__metrics is not None:
+                        self.__metrics.mark_filtered()
+                    continue
+
+                self.__add(msg=msg)
+
+    def size(self) -> int:
+        """
+        :return: number of pending messages
+        """
+        with self.__mu:  # pylint: disable=not-context-manager
+            return len(self.__paths)
+
+    def total_bytes(self) -> int:
+        """
+        :return: total size of the pending messages in bytes
+        """
+        with self.__mu:  # pylint: disable=not-context-manager
+            return self.__total_bytes
+
+    def expire(self, max_age: Optional[float] = None, max_bytes: Optional[int] = None) -> int:
+        """
+        removes the oldest pending messages which violate the retention policy.
+
+        The expired messages are removed from the internal queue in a single step under the lock, while their files
+        are deleted only after the lock has been released so that adding messages is blocked only briefly.
+
+        :param max_age: if set, messages received more than max_age seconds ago are removed
+        :param max_bytes: if set, the oldest messages are removed until the pending messages fit in max_bytes
+        :return: number of removed messages
+        """
+        with self.__mu:  # pylint: disable=not-context-manager
+            count = 0
+            if max_age is not None:
+                count = bisect.bisect_left(self.__timestamps, time.time() - max_age)
+
+            removed_bytes = sum(self.__sizes[:count])
+
+            if max_bytes is not None:
+                while count < len(self.__sizes) and self.__total_bytes - removed_bytes > max_bytes:
+                    removed_bytes += self.__sizes[count]
+                    count += 1
+
+            if count == 0:
+                return 0
+
+            expired = self.__paths[:count]
+
+            del self.__paths[:count]
+            del self.__sizes[:count]
+            del self.__timestamps[:count]
+            self.__total_bytes -= removed_bytes
+
+            self.__time_index.drop_before(first_index=self.__first_index())
+
+            self.__first_decoded = None
+            self.__first_is_decoded = False
+            self.__first = self.__paths[0].read_bytes() if self.__paths else None
+
+            if self.__metrics is not None:
+                del self.__persisted_at[:count]
+                self.__metrics.increment(name=persizmq.metrics.EXPIRED, amount=count)
+                self.__metrics.set_gauge(name=persizmq.metrics.QUEUE_DEPTH, value=len(self.__paths))
+
+        for pth in expired:
+            pth.unlink()
+
+        return count
+
+    def seek(self, timestamp: float) -> int:
+        """
+        finds the first pending message received at or after the timestamp. Only the messages since the closest
+        entry of the time index are inspected.
+
+        :param timestamp: receive time as seconds since epoch
+        :return: sequence number of the message, or of the next message to be added if there is no such message
+        """
+        with self.__mu:  # pylint: disable=not-context-manager
+            paths = list(self.__paths)
+            count = self.__count
+            lower_bound = self.__time_index.lower_bound(timestamp=timestamp)
+
+        for index, _, _ in self.__scan(paths=paths, lower_bound=lower_bound, start=timestamp):
+            return index
+
+        return count
+
+    def replay(self, start: float, end: Optional[float] = None) -> Iterator[Tuple[float, bytes]]:
+        """
+        streams the pending messages received in the time range [start, end) without removing them. The messages
+        are read from disk one at a time; messages added after the call are not included.
+
+        :param start: receive time as seconds since epoch
+        :param end: if set, receive time as seconds since epoch where the replay stops
+        :return: generator of (receive time, message)
+        """
+        with self.__mu:  # pylint: disable=not-context-manager
+            paths = list(self.__paths)
+            lower_bound = self.__time_index.lower_bound(timestamp=start)
+
+        for _, timestamp, pth in self.__scan(paths=paths, lower_bound=lower_bound, start=start):
+            if end is not None and timestamp >= end:
+                break
 
             try:
-                assert tmp_pth is not None, "Unexpected tmp_pth None; expected it to be initialized just before."
-                tmp_pth.write_bytes(msg)
-                tmp_pth.rename(pth)
-                tmp_pth = None
+                msg = pth.read_bytes()
+            except FileNotFoundError:
+                # The message has been popped in the meanwhile.
+                continue
 
-                self.__paths.append(pth)
-                self.__count += 1
+            yield timestamp, msg
 
-                if self.__first is None:
-                    self.__first = msg
+    @staticmethod
+    def __scan(paths: List[pathlib.Path], lower_bound: Optional[int],
+               start: float) -> Iterator[Tuple[int, float, pathlib.Path]]:
+        """
+        iterates over the messages received at or after the start.
 
-            finally:
-                if tmp_pth is not None and tmp_pth.exists():  # type: ignore
-                    tmp_pth.unlink()  # type: ignore
+        :param paths: snapshot of the pending message files
+        :param lower_bound: sequence number from the time index where the scan can begin
+        :param start: receive time as seconds since epoch
+        :return: generator of (sequence number, receive time, path)
+        """
+        if not paths:
+            return
+
+        first_index = int(paths[0].stem)
+        position = 0 if lower_bound is None else max(0, lower_bound - first_index)
+
+        for pth in paths[position:]:
+            try:
+                timestamp = pth.stat().st_mtime
+            except FileNotFoundError:
+                # The message has been popped in the meanwhile.
+                continue
+
+            if timestamp >= start:
+                yield int(pth.stem), timestamp, pth
+
+    def add_object(self, obj: Any) -> None:
+        """
+        encodes the object with the codec and adds it to the persistent storage's internal queue.
+
+        :param obj: object to be added
+        """
+        if self.__codec is None:
+            raise ValueError("No codec has been specified for the persistent storage.")
+
+        self.add_message(self.__codec.encode(obj))
 
 
 class PersistentLatestStorage:
@@ -235,7 +772,17 @@ class PersistentLatestStorage:
     persists only the latest received message.
     """
 
-    def __init__(self, persistent_dir: Union[str, pathlib.Path]) -> None:
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self,
+                 persistent_dir: Union[str, pathlib.Path],
+                 metrics: Optional[persizmq.metrics.Metrics] = None,
+                 codec: Optional[persizmq.codec.Codec] = None) -> None:
+        """
+        :param persistent_dir: directory where the latest message is stored
+        :param metrics: if set, counts the filtered and persisted messages and records the latencies
+        :param codec: if set, enables message_object and add_object
+        """
         if isinstance(persistent_dir, str):
             self.__persistent_dir = pathlib.Path(persistent_dir)
         elif isinstance(persistent_dir, pathlib.Path):
@@ -251,6 +798,13 @@ class PersistentLatestStorage:
         self.__persistent_file = self.__persistent_dir / "persistent_message.bin"
         self.new_message = False
 
+        self.__metrics = metrics
+
+        self.__codec = codec
+        # The latest message is decoded at most once and the decoded object is cached until it is replaced.
+        self.__decoded = None  # type: Any
+        self.__is_decoded = False
+
         if self.__persistent_file.exists():
             self.__message = self.__persistent_file.read_bytes()
             self.new_message = True
@@ -262,9 +816,13 @@ class PersistentLatestStorage:
         :param msg: new message
         """
         if msg is None:
+            if self.__metrics is not None:
+                self.__metrics.mark_filtered()
             return
 
         with self.__mu:
+            start = time.monotonic() if self.__metrics is not None else 0.0
+
             tmp_pth = self.__persistent_file.with_suffix(".tmp")
             try:
                 tmp_pth.write_bytes(msg)
@@ -272,6 +830,11 @@ class PersistentLatestStorage:
 
                 self.new_message = True
                 self.__message = msg
+                self.__decoded = None
+                self.__is_decoded = False
+
+                if self.__metrics is not None:
+                    self.__metrics.mark_persisted(write_duration=time.monotonic() - start)
             finally:
                 if tmp_pth.exists():
                     tmp_pth.unlink()
@@ -285,3 +848,35 @@ class PersistentLatestStorage:
         with self.__mu:
             self.new_message = False
             return copy.deepcopy(self.__message)
+
+    def message_object(self) -> Any:
+        """
+        gets the latest message decoded with the codec. The message is decoded only once; the subsequent calls return
+        the same object, so do not modify it.
+
+        :return: latest decoded message or None, if no message so far.
+        """
+        if self.__codec is None:
+            raise ValueError("No codec has been specified for the persistent latest storage.")
+
+        with self.__mu:
+            self.new_message = False
+            if self.__message is None:
+                return None
+
+            if not self.__is_decoded:
+                self.__decoded = self.__codec.decode(self.__message)
+                self.__is_decoded = True
+
+            return self.__decoded
+
+    def add_object(self, obj: Any) -> None:
+        """
+        encodes the object with the codec and replaces the latest message with it.
+
+        :param obj: new object
+        """
+        if self.__codec is None:
+            raise ValueError("No codec has been specified for the persistent latest storage.")
+
+        self.add_message(self.__codec.encode(obj))
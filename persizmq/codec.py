@@ -0,0 +1,89 @@
+""" provides codecs to encode and decode the messages. """
+
+import abc
+import json
+import pickle
+from typing import Any
+
+
+class Codec(abc.ABC):
+    """
+    converts between objects and the bytes sent over zeromq and persisted on disk.
+
+    Subclass it and implement both encode and decode to provide your own codec.
+    """
+
+    @abc.abstractmethod
+    def encode(self, obj: Any) -> bytes:
+        """
+        :param obj: to be encoded
+        :return: encoded object
+        """
+
+    @abc.abstractmethod
+    def decode(self, data: bytes) -> Any:
+        """
+        :param data: encoded object
+        :return: decoded object
+        """
+
+
+class Raw(Codec):
+    """
+    passes the bytes through unchanged.
+    """
+
+    def encode(self, obj: Any) -> bytes:
+        if not isinstance(obj, bytes):
+            raise TypeError("expected bytes, got: {}".format(obj.__class__.__name__))
+
+        return obj
+
+    def decode(self, data: bytes) -> Any:
+        return data
+
+
+class Json(Codec):
+    """
+    encodes the objects as UTF-8 JSON.
+    """
+
+    def encode(self, obj: Any) -> bytes:
+        return json.dumps(obj).encode('utf-8')
+
+    def decode(self, data: bytes) -> Any:
+        return json.loads(data.decode('utf-8'))
+
+
+class Pickle(Codec):
+    """
+    pickles the objects. Decode only the messages from trusted sources!
+    """
+
+    def __init__(self, protocol: int = pickle.HIGHEST_PROTOCOL) -> None:
+        """
+        :param protocol: pickle protocol used for encoding
+        """
+        self.protocol = protocol
+
+    def encode(self, obj: Any) -> bytes:
+        return pickle.dumps(obj, protocol=self.protocol)
+
+    def decode(self, data: bytes) -> Any:
+        return pickle.loads(data)
+
+
+class Msgpack(Codec):
+    """
+    encodes the objects with msgpack. Requires the msgpack package (pip3 install persizmq[msgpack]).
+    """
+
+    def __init__(self) -> None:
+        import msgpack  # pylint: disable=import-error
+        self.__msgpack = msgpack
+
+    def encode(self, obj: Any) -> bytes:
+        return self.__msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, data: bytes) -> Any:
+        return self.__msgpack.unpackb(data, raw=False)
@@ -0,0 +1,243 @@
+""" provides a queue which keeps the messages in memory and spills them to disk only when needed. """
+
+import collections
+import copy
+import pathlib
+import threading
+import time
+import weakref
+from typing import List, Optional, Union  # pylint: disable=unused-import
+
+import persizmq
+
+
+def _spill(memory: collections.deque, storage: persizmq.PersistentStorage) -> None:
+    """
+    moves all the messages from memory to disk. Expects the caller to hold the lock.
+
+    :param memory: buffered messages as (monotonic time of arrival, message)
+    :param storage: on-disk part of the queue
+    """
+    while memory:
+        _, msg = memory[0]
+        storage.add_message(msg)
+        memory.popleft()
+
+
+def _flush(memory: collections.deque, storage: persizmq.PersistentStorage, mu: threading.Lock) -> None:
+    """
+    moves all the messages from memory to disk.
+
+    :param memory: buffered messages as (monotonic time of arrival, message)
+    :param storage: on-disk part of the queue
+    :param mu: lock guarding the memory and the storage
+    """
+    with mu:
+        _spill(memory=memory, storage=storage)
+
+
+def _raise_watch_error(watch_error: List[Optional[Exception]]) -> None:
+    """
+    re-raises the last error of the watching thread, if any, and clears it. Expects the caller to hold the lock.
+
+    :param watch_error: holds the last error of the watching thread
+    """
+    err = watch_error[0]
+    if err is not None:
+        watch_error[0] = None
+        raise err  # pylint: disable=raising-bad-type
+
+
+def _watch(memory: collections.deque, storage: persizmq.PersistentStorage, mu: threading.Lock, max_lag: float,
+           stop: threading.Event, watch_error: List[Optional[Exception]]) -> None:
+    """
+    spills the buffered messages to disk once the oldest one has waited longer than max_lag, even if no message is
+    added or popped. This function is expected to run in a separate thread.
+
+    :param memory: buffered messages as (monotonic time of arrival, message)
+    :param storage: on-disk part of the queue
+    :param mu: lock guarding the memory and the storage
+    :param max_lag: maximum time in seconds a message is buffered
+    :param stop: set to stop watching
+    :param watch_error: the error of a failed spill is stored here so that the storage can re-raise it
+    """
+    # pylint: disable=too-many-arguments
+    timeout = max_lag
+    while not stop.wait(timeout=timeout):
+        with mu:
+            try:
+                if memory and time.monotonic() - memory[0][0] >= max_lag:
+                    _spill(memory=memory, storage=storage)
+
+                timeout = max_lag if not memory else max(0.0, memory[0][0] + max_lag - time.monotonic())
+
+            except Exception as err:  # pylint: disable=broad-except
+                # Retry only after max_lag so that a persistent failure does not keep the thread spinning.
+                watch_error[0] = err
+                timeout = max_lag
+
+
+def _close(memory: collections.deque, storage: persizmq.PersistentStorage, mu: threading.Lock,
+           stop: threading.Event) -> None:
+    """
+    stops watching the lag and moves all the messages from memory to disk.
+
+    :param memory: buffered messages as (monotonic time of arrival, message)
+    :param storage: on-disk part of the queue
+    :param mu: lock guarding the memory and the storage
+    :param stop: stops the watching thread when set
+    """
+    stop.set()
+    _flush(memory=memory, storage=storage, mu=mu)
+
+
+class HybridStorage:
+    """
+    keeps the received messages in a bounded in-memory buffer and spills them to disk only if the consumer does
+    not keep up.
+
+    The messages are spilled to disk when the buffer exceeds memory_capacity or when the oldest buffered message
+    has waited longer than max_lag. The two limits are the durability trade-off: a crash loses at most the buffered
+    messages, i.e. at most memory_capacity messages which arrived within the last max_lag seconds. The lag is checked
+    whenever a message is added or popped and by a separate thread, so it is bounded also when there is no traffic.
+    Set memory_capacity to 0 to write every message through to disk.
+
+    The buffer is flushed to disk and the lag thread is stopped on close (or when leaving the context) and, as a last
+    resort, when the storage is garbage-collected or the interpreter exits normally.
+
+    If the lag thread fails to spill the buffer, it retries after max_lag and the error is re-raised by the next call
+    to add_message, pop_front, flush or close.
+
+    The messages on disk are always older than the buffered ones, so the FIFO order is kept.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self,
+                 persistent_dir: Union[str, pathlib.Path],
+                 memory_capacity: int = 1024,
+                 max_lag: Optional[float] = 1.0) -> None:
+        """
+        :param persistent_dir: directory where the spilled messages are stored
+        :param memory_capacity: maximum number of buffered messages
+        :param max_lag: if set, maximum time in seconds a message is buffered before it is spilled to disk
+        """
+        if memory_capacity < 0:
+            raise ValueError("Expected a non-negative memory_capacity, got: {}".format(memory_capacity))
+
+        self.memory_capacity = memory_capacity
+        self.max_lag = max_lag
+
+        self.__mu = threading.Lock()
+        self.__storage = persizmq.PersistentStorage(persistent_dir=persistent_dir)
+        self.__memory = collections.deque()  # type: collections.deque
+        self.__stop = threading.Event()
+        self.__watch_error = [None]  # type: List[Optional[Exception]]
+
+        if max_lag is not None and memory_capacity > 0:
+            # The thread must not reference self either, otherwise the storage would never be garbage-collected.
+            watcher = threading.Thread(
+                target=_watch,
+                args=(self.__memory, self.__storage, self.__mu, max_lag, self.__stop, self.__watch_error),
+                daemon=True)
+            watcher.start()
+
+        # The finalizer must not reference self, otherwise the storage would never be garbage-collected.
+        self.__finalizer = weakref.finalize(self, _close, self.__memory, self.__storage, self.__mu, self.__stop)
+
+    def __spill_if_needed(self) -> None:
+        """
+        spills the buffered messages to disk if the buffer is too large or the consumer lags behind. Expects
+        the caller to hold the lock.
+        """
+        if not self.__memory:
+            return
+
+        too_large = len(self.__memory) > self.memory_capacity
+        too_old = self.max_lag is not None and time.monotonic() - self.__memory[0][0] > self.max_lag
+
+        if too_large or too_old:
+            _spill(memory=self.__memory, storage=self.__storage)
+
+    def buffered(self) -> int:
+        """
+        :return: number of messages kept only in memory
+        """
+        with self.__mu:
+            return len(self.__memory)
+
+    def front(self) -> Optional[bytes]:
+        """
+        makes a copy of the first pending message, but does not remove it from the queue.
+
+        :return: copy of the first message, or None if no message in the queue
+        """
+        with self.__mu:
+            msg = self.__storage.front()
+            if msg is not None:
+                return msg
+
+            if self.__memory:
+                return copy.deepcopy(self.__memory[0][1])
+
+            return None
+
+    def pop_front(self) -> bool:
+        """
+        removes a message from the queue.
+
+        :return: True if there was a message in the queue
+        """
+        with self.__mu:
+            _raise_watch_error(watch_error=self.__watch_error)
+
+            if self.__storage.pop_front():
+                result = True
+            elif self.__memory:
+                self.__memory.popleft()
+                result = True
+            else:
+                result = False
+
+            self.__spill_if_needed()
+            return result
+
+    def add_message(self, msg: Optional[bytes]) -> None:
+        """
+        adds a message to the queue.
+
+        :param msg: message to be added
+        """
+        if msg is None:
+            return
+
+        with self.__mu:
+            _raise_watch_error(watch_error=self.__watch_error)
+
+            self.__memory.append((time.monotonic(), msg))
+            self.__spill_if_needed()
+
+    def flush(self) -> None:
+        """
+        spills all the buffered messages to disk.
+        """
+        _flush(memory=self.__memory, storage=self.__storage, mu=self.__mu)
+
+        with self.__mu:
+            _raise_watch_error(watch_error=self.__watch_error)
+
+    def close(self) -> None:
+        """
+        stops the lag thread and flushes the buffered messages to disk. The storage can still be used afterwards,
+        but the lag is then only checked when a message is added or popped.
+        """
+        _close(memory=self.__memory, storage=self.__storage, mu=self.__mu, stop=self.__stop)
+
+        with self.__mu:
+            _raise_watch_error(watch_error=self.__watch_error)
+
+    def __enter__(self) -> 'HybridStorage':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
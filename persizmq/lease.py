@@ -0,0 +1,222 @@
+""" provides a persistent queue which hands out distinct messages to concurrent consumers. """
+
+# pylint: disable=protected-access
+
+import collections
+import contextlib
+import fcntl
+import heapq
+import pathlib
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple, Union  # pylint: disable=unused-import
+
+import persizmq
+import persizmq.codec
+import persizmq.metrics
+
+
+class LeasedStorage:
+    """
+    persists received messages on disk and leases them to concurrent consumers.
+
+    A consumer claims a message, processes it and acknowledges it with ack (the message is deleted) or rejects it
+    with nack (the message is immediately available again). A message whose lease is neither acknowledged nor
+    rejected within the lease timeout (e.g., because the worker thread died) is handed out again. Leases are kept
+    in memory, so all the messages still on disk are pending again after a restart.
+
+    The leases are shared among the threads of a single process. The storage holds an exclusive fcntl lock on the
+    persistent directory (POSIX only) so that a second process, or a second instance, can not open it and hand out
+    the same messages. Close the storage to release the lock.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self,
+                 persistent_dir: Union[str, pathlib.Path],
+                 lease_timeout: float = 60.0,
+                 metrics: Optional[persizmq.metrics.Metrics] = None,
+                 codec: Optional[persizmq.codec.Codec] = None) -> None:
+        """
+        :param persistent_dir: directory where the messages are stored
+        :param lease_timeout: time in seconds after which an unacknowledged message is handed out again
+        :param metrics: if set, counts the filtered, persisted and acknowledged (popped) messages
+        :param codec: if set, enables claim_object and add_object
+        """
+        if lease_timeout <= 0.0:
+            raise ValueError("Expected a positive lease_timeout, got: {}".format(lease_timeout))
+
+        self.lease_timeout = lease_timeout
+        self.__codec = codec
+
+        self.__persistent_dir = persizmq._to_path(persistent_dir=persistent_dir)
+        self.__persistent_dir.mkdir(exist_ok=True, parents=True)
+
+        self.__exit_stack = contextlib.ExitStack()
+        lock_file = self.__exit_stack.enter_context((self.__persistent_dir / "lock").open("a+b"))
+        locked = True
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            locked = False
+
+        if not locked:
+            self.__exit_stack.close()
+            raise RuntimeError("The persistent directory {!r} is already used by another leased storage.".format(
+                str(self.__persistent_dir)))
+
+        self.__mu = threading.Lock()
+        self.__metrics = metrics
+
+        paths, self.__count = persizmq._recover_messages(persistent_dir=self.__persistent_dir)
+
+        self.__paths = {int(pth.stem): pth for pth in paths}  # type: Dict[int, pathlib.Path]
+
+        # min-heap of the identifiers of the messages available for claiming
+        self.__available = sorted(self.__paths.keys())  # type: List[int]
+
+        # lease -> (message identifier, deadline); the timeout is constant, so the insertion order is also the
+        # deadline order. Every claim issues a new lease so that a late ack of an expired lease is rejected even if
+        # the message has been claimed again in the meanwhile.
+        self.__leases = collections.OrderedDict()  # type: Dict[int, Tuple[int, float]]
+        self.__lease_count = 0
+
+        if self.__metrics is not None:
+            self.__metrics.set_gauge(name=persizmq.metrics.QUEUE_DEPTH, value=len(self.__paths))
+
+    def __expire_leases(self) -> None:
+        """
+        makes the messages with expired leases available again. Expects the caller to hold the lock.
+        """
+        now = time.monotonic()
+        while self.__leases:
+            lease, (identifier, deadline) = next(iter(self.__leases.items()))
+            if deadline > now:
+                break
+
+            del self.__leases[lease]
+            heapq.heappush(self.__available, identifier)
+
+    def claim(self) -> Optional[Tuple[int, bytes]]:
+        """
+        leases the oldest available message.
+
+        :return: (lease, message) where the lease is to be passed to ack or nack, or None if no message is available
+        """
+        with self.__mu:
+            self.__expire_leases()
+
+            if not self.__available:
+                return None
+
+            identifier = heapq.heappop(self.__available)
+
+            lease = self.__lease_count
+            self.__lease_count += 1
+            self.__leases[lease] = (identifier, time.monotonic() + self.lease_timeout)
+
+            return lease, self.__paths[identifier].read_bytes()
+
+    def claim_object(self) -> Optional[Tuple[int, Any]]:
+        """
+        leases the oldest available message and decodes it with the codec.
+
+        :return: (lease, object) where the lease is to be passed to ack or nack, or None if no message is available
+        """
+        if self.__codec is None:
+            raise ValueError("No codec has been specified for the leased storage.")
+
+        claimed = self.claim()
+        if claimed is None:
+            return None
+
+        lease, msg = claimed
+        return lease, self.__codec.decode(msg)
+
+    def ack(self, lease: int) -> bool:
+        """
+        acknowledges the claimed message and removes it from the storage.
+
+        :param lease: as returned by claim
+        :return: True if the lease was valid; False if it had already expired or is unknown
+        """
+        with self.__mu:
+            self.__expire_leases()
+
+            if lease not in self.__leases:
+                return False
+
+            identifier, _ = self.__leases.pop(lease)
+            self.__paths.pop(identifier).unlink()
+
+            if self.__metrics is not None:
+                self.__metrics.increment(name=persizmq.metrics.POPPED)
+                self.__metrics.set_gauge(name=persizmq.metrics.QUEUE_DEPTH, value=len(self.__paths))
+
+            return True
+
+    def nack(self, lease: int) -> bool:
+        """
+        releases the lease so that the message can be claimed again immediately.
+
+        :param lease: as returned by claim
+        :return: True if the lease was valid; False if it had already expired or is unknown
+        """
+        with self.__mu:
+            self.__expire_leases()
+
+            if lease not in self.__leases:
+                return False
+
+            identifier, _ = self.__leases.pop(lease)
+            heapq.heappush(self.__available, identifier)
+            return True
+
+    def pending(self) -> int:
+        """
+        :return: number of messages in the storage including the leased ones
+        """
+        with self.__mu:
+            return len(self.__paths)
+
+    def add_message(self, msg: Optional[bytes]) -> None:
+        """
+        adds a message to the storage and makes it available for claiming.
+
+        :param msg: message to be added
+        """
+        if msg is None:
+            persizmq._mark_filtered(metrics=self.__metrics)
+            return
+
+        with self.__mu:
+            self.__paths[self.__count] = persizmq._write_message(
+                persistent_dir=self.__persistent_dir, index=self.__count, msg=msg, metrics=self.__metrics)
+            heapq.heappush(self.__available, self.__count)
+            self.__count += 1
+
+            if self.__metrics is not None:
+                self.__metrics.set_gauge(name=persizmq.metrics.QUEUE_DEPTH, value=len(self.__paths))
+
+    def add_object(self, obj: Any) -> None:
+        """
+        encodes the object with the codec and adds it to the storage.
+
+        :param obj: object to be added
+        """
+        if self.__codec is None:
+            raise ValueError("No codec has been specified for the leased storage.")
+
+        self.add_message(self.__codec.encode(obj))
+
+    def close(self) -> None:
+        """
+        releases the lock on the persistent directory. The messages remain on disk; the leases are lost.
+        """
+        self.__exit_stack.close()
+
+    def __enter__(self) -> 'LeasedStorage':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,249 @@
+""" provides lightweight metrics for the threaded subscriber and the storages. """
+
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional  # pylint: disable=unused-import
+
+# Names of the counters, gauges and histograms updated by persizmq itself.
+RECEIVED = "received"
+FILTERED = "filtered"
+PERSISTED = "persisted"
+POPPED = "popped"
+SENT = "sent"
+CONFLATED = "conflated"
+EXPIRED = "expired"
+DROPPED = "dropped"
+SPILLED = "spilled"
+
+QUEUE_DEPTH = "queue_depth"
+WRITE_QUEUE_DEPTH = "write_queue_depth"
+
+WRITE_LATENCY = "write_latency"
+RECV_TO_PERSIST = "recv_to_persist"
+PERSIST_TO_CONSUME = "persist_to_consume"
+
+
+class Histogram:
+    """
+    records latencies in log-linear buckets (in the spirit of HDR histograms).
+
+    Values are recorded in microseconds. Every power of two is split into 2 ** (sub_bucket_bits - 1) linear
+    sub-buckets so that the relative error of a reported percentile is bounded by 2 ** -(sub_bucket_bits - 1)
+    independent of the magnitude of the value. Buckets are kept sparse, so an idle histogram costs next to nothing.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, sub_bucket_bits: int = 6) -> None:
+        """
+        :param sub_bucket_bits: number of significant bits kept per value
+        """
+        if sub_bucket_bits < 2:
+            raise ValueError("Expected sub_bucket_bits >= 2, got: {}".format(sub_bucket_bits))
+
+        self.__bits = sub_bucket_bits
+        self.__sub_count = 1 << sub_bucket_bits
+        self.__half_count = 1 << (sub_bucket_bits - 1)
+
+        self.__buckets = dict()  # type: Dict[int, int]
+        self.count = 0
+        self.total = 0
+        self.min = 0
+        self.max = 0
+
+    def __index(self, value: int) -> int:
+        """
+        :param value: in microseconds
+        :return: index of the bucket holding the value
+        """
+        if value < self.__sub_count:
+            return value
+
+        shift = value.bit_length() - self.__bits
+        return self.__sub_count + (shift - 1) * self.__half_count + ((value >> shift) - self.__half_count)
+
+    def __value(self, index: int) -> int:
+        """
+        :param index: of a bucket
+        :return: the mid-point of the bucket in microseconds
+        """
+        if index < self.__sub_count:
+            return index
+
+        shift = (index - self.__sub_count) // self.__half_count + 1
+        top = (index - self.__sub_count) % self.__half_count + self.__half_count
+        return (top << shift) + (1 << (shift - 1))
+
+    def record(self, seconds: float) -> None:
+        """
+        records a single value.
+
+        :param seconds: latency in seconds
+        """
+        value = max(0, int(seconds * 1e6))
+
+        index = self.__index(value)
+        self.__buckets[index] = self.__buckets.get(index, 0) + 1
+
+        if self.count == 0 or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+        self.count += 1
+        self.total += value
+
+    def percentile(self, percent: float) -> int:
+        """
+        :param percent: in the range [0, 100]
+        :return: approximate value at the given percentile in microseconds, 0 if nothing has been recorded
+        """
+        if self.count == 0:
+            return 0
+
+        threshold = max(1, int(round(self.count * percent / 100.0)))
+        seen = 0
+        for index in sorted(self.__buckets.keys()):
+            seen += self.__buckets[index]
+            if seen >= threshold:
+                return min(self.__value(index), self.max)
+
+        return self.max
+
+    def snapshot(self) -> Dict[str, float]:
+        """
+        :return: summary of the recorded values in microseconds
+        """
+        return {
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.total / self.count if self.count > 0 else 0.0,
+            "p50": self.percentile(50.0),
+            "p90": self.percentile(90.0),
+            "p99": self.percentile(99.0),
+            "p999": self.percentile(99.9)
+        }
+
+
+class Metrics:
+    """
+    collects counters, gauges and latency histograms.
+
+    Pass the same instance to ThreadedSubscriber and the storages to follow a message from its reception to its
+    consumption. Components given no metrics (the default) skip all the bookkeeping.
+    """
+
+    def __init__(self, sub_bucket_bits: int = 6) -> None:
+        """
+        :param sub_bucket_bits: precision of the histograms, see Histogram
+        """
+        self.__mu = threading.Lock()
+        self.__sub_bucket_bits = sub_bucket_bits
+
+        self.__counters = dict()  # type: Dict[str, int]
+        self.__gauges = dict()  # type: Dict[str, float]
+        self.__histograms = dict()  # type: Dict[str, Histogram]
+
+        self.__local = threading.local()
+
+        # Hooks are called as hook(name, value) on every update, outside of the internal lock.
+        self.hooks = []  # type: List[Callable[[str, float], None]]
+
+    def increment(self, name: str, amount: int = 1) -> None:
+        """
+        increments the counter.
+
+        :param name: of the counter
+        :param amount: to add
+        """
+        with self.__mu:
+            value = self.__counters.get(name, 0) + amount
+            self.__counters[name] = value
+
+        for hook in self.hooks:
+            hook(name, value)
+
+    def set_gauge(self, name: str, value: float) -> None:
+        """
+        sets the gauge to the value.
+
+        :param name: of the gauge
+        :param value: new value
+        """
+        with self.__mu:
+            self.__gauges[name] = value
+
+        for hook in self.hooks:
+            hook(name, value)
+
+    def observe(self, name: str, seconds: float) -> None:
+        """
+        records a latency in the histogram.
+
+        :param name: of the histogram
+        :param seconds: latency
+        """
+        with self.__mu:
+            histogram = self.__histograms.get(name, None)
+            if histogram is None:
+                histogram = Histogram(sub_bucket_bits=self.__sub_bucket_bits)
+                self.__histograms[name] = histogram
+
+            histogram.record(seconds=seconds)
+
+        for hook in self.hooks:
+            hook(name, seconds)
+
+    def mark_received(self) -> None:
+        """
+        marks that the current thread received a message. The mark is consumed by the next call to mark_persisted
+        in the same thread, which is how ThreadedSubscriber and the storages measure the reception-to-persistence
+        latency without passing timestamps through the callback.
+        """
+        self.__local.received_at = time.monotonic()
+        self.increment(name=RECEIVED)
+
+    def take_received(self) -> Optional[float]:
+        """
+        consumes the reception mark of the current thread so that the message can be persisted in another thread.
+        Observe RECV_TO_PERSIST with the returned time once the message has been persisted.
+
+        :return: monotonic time when the message was received in the current thread, if marked
+        """
+        received_at = getattr(self.__local, "received_at", None)
+        self.__local.received_at = None
+        return received_at
+
+    def mark_filtered(self) -> None:
+        """
+        marks that the message received in the current thread has been filtered out and will not be persisted.
+        """
+        self.__local.received_at = None
+        self.increment(name=FILTERED)
+
+    def mark_persisted(self, write_duration: float) -> None:
+        """
+        marks that a message has been persisted in the current thread.
+
+        :param write_duration: time in seconds spent writing the message to disk
+        """
+        self.increment(name=PERSISTED)
+        self.observe(name=WRITE_LATENCY, seconds=write_duration)
+
+        received_at = getattr(self.__local, "received_at", None)
+        if received_at is not None:
+            self.__local.received_at = None
+            self.observe(name=RECV_TO_PERSIST, seconds=time.monotonic() - received_at)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        :return: copy of the current state as {"counters": ..., "gauges": ..., "histograms": ...}
+        """
+        with self.__mu:
+            return {
+                "counters": dict(self.__counters),
+                "gauges": dict(self.__gauges),
+                "histograms": {name: histogram.snapshot()
+                               for name, histogram in self.__histograms.items()}
+            }
@@ -0,0 +1,281 @@
+""" provides a persistent queue read by multiple consumers. """
+
+# pylint: disable=protected-access
+
+import copy
+import pathlib
+import re
+import struct
+import threading
+from typing import Any, Dict, List, Optional, Union  # pylint: disable=unused-import
+
+import persizmq
+import persizmq.codec
+import persizmq.metrics
+
+_CONSUMER_RE = re.compile(r'^[a-zA-Z0-9_.-]+$')
+
+# A cursor file holds the cursor as a fixed-size integer which is overwritten in place.
+_CURSOR_FORMAT = "<Q"
+_CURSOR_SIZE = struct.calcsize(_CURSOR_FORMAT)
+
+
+class MultiConsumerStorage:
+    """
+    persists received messages on disk once and lets each named consumer read them independently.
+
+    Every consumer has its own cursor which is persisted in the "cursors" subdirectory. The cursor file has a fixed
+    size and is overwritten in place on every pop, so consuming a message does not create any file. The write is not
+    synced to disk, so a crash of the machine may lose the latest pops and the consumer reads those messages again;
+    a crash of the process alone loses nothing.
+
+    A message file is deleted only when all the cursors have passed it. The cursors found on disk are kept even if
+    the consumer is not listed in the constructor; use remove_consumer to stop retaining messages for a consumer that
+    went away.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self,
+                 persistent_dir: Union[str, pathlib.Path],
+                 consumers: List[str],
+                 metrics: Optional[persizmq.metrics.Metrics] = None,
+                 codec: Optional[persizmq.codec.Codec] = None) -> None:
+        """
+        :param persistent_dir: directory where the messages and the cursors are stored
+        :param consumers: names of the consumers; new consumers start at the oldest retained message
+        :param metrics: if set, counts the filtered, persisted and popped messages
+        :param codec: if set, enables front_object and add_object
+        """
+        self.__persistent_dir = persizmq._to_path(persistent_dir=persistent_dir)
+        self.__persistent_dir.mkdir(exist_ok=True, parents=True)
+
+        self.__cursor_dir = self.__persistent_dir / "cursors"
+        self.__cursor_dir.mkdir(exist_ok=True)
+
+        self.__mu = threading.Lock()
+        self.__metrics = metrics
+        self.__codec = codec
+
+        self.__paths, self.__count = persizmq._recover_messages(persistent_dir=self.__persistent_dir)
+
+        self.__cursors = dict()  # type: Dict[str, int]
+
+        # The messages at the cursors are read and decoded once and shared among the consumers at the same position.
+        self.__messages = dict()  # type: Dict[int, bytes]
+        self.__decoded = dict()  # type: Dict[int, Any]
+
+        for pth in sorted(self.__cursor_dir.iterdir()):
+            if pth.suffix == ".tmp":
+                pth.unlink()
+            elif pth.suffix == ".cursor":
+                data = pth.read_bytes()
+                if len(data) != _CURSOR_SIZE:
+                    raise ValueError("Failed to load the cursor from the file {!r}.".format(str(pth)))
+
+                self.__cursors[pth.stem], = struct.unpack(_CURSOR_FORMAT, data)
+
+        # If all the messages have been consumed and deleted, the directory holds no message files and the sequence
+        # numbers would restart at 0. Continue after the cursors instead so that a new message is never mistaken for
+        # an already consumed one.
+        if self.__cursors:
+            self.__count = max(self.__count, max(self.__cursors.values()))
+
+        # sequence number of the oldest retained message
+        self.__first_index = int(self.__paths[0].stem) if self.__paths else self.__count
+
+        for consumer, cursor in self.__cursors.items():
+            self.__cursors[consumer] = min(max(cursor, self.__first_index), self.__count)
+
+        for consumer in consumers:
+            if consumer not in self.__cursors:
+                self.__add_consumer(consumer=consumer)
+
+        self.__collect_garbage()
+
+    def __cursor_path(self, consumer: str) -> pathlib.Path:
+        """
+        :param consumer: name of the consumer
+        :return: path to the file holding the cursor
+        """
+        return self.__cursor_dir / "{}.cursor".format(consumer)
+
+    def __add_consumer(self, consumer: str) -> None:
+        """
+        registers the consumer at the oldest retained message. Expects the caller to hold the lock if needed.
+
+        :param consumer: name of the consumer
+        """
+        if not _CONSUMER_RE.match(consumer):
+            raise ValueError("Expected the consumer name to match {}, got: {!r}".format(_CONSUMER_RE.pattern, consumer))
+
+        self.__cursors[consumer] = self.__first_index
+        persizmq._write_atomically(
+            path=self.__cursor_path(consumer=consumer), data=struct.pack(_CURSOR_FORMAT, self.__first_index))
+
+    def __cursor(self, consumer: str) -> int:
+        """
+        :param consumer: name of the consumer
+        :return: sequence number of the next message to be read by the consumer
+        """
+        if consumer not in self.__cursors:
+            raise KeyError("Unknown consumer: {!r}".format(consumer))
+
+        return self.__cursors[consumer]
+
+    def __message(self, index: int) -> bytes:
+        """
+        :param index: sequence number of a retained message
+        :return: the message, cached while any cursor points to it; expects the caller to hold the lock
+        """
+        if index not in self.__messages:
+            self.__messages[index] = self.__paths[index - self.__first_index].read_bytes()
+
+        return self.__messages[index]
+
+    def __evict(self, index: int) -> None:
+        """
+        drops the cached message unless a cursor still points to it; expects the caller to hold the lock.
+
+        :param index: sequence number of the message
+        """
+        if index not in self.__cursors.values():
+            self.__messages.pop(index, None)
+            self.__decoded.pop(index, None)
+
+    def __collect_garbage(self) -> None:
+        """
+        deletes the message files which all the consumers have already passed. Expects the caller to hold the lock
+        if needed.
+        """
+        if not self.__cursors:
+            return
+
+        min_cursor = min(self.__cursors.values())
+        while self.__paths and self.__first_index < min_cursor:
+            pth = self.__paths.pop(0)
+            pth.unlink()
+            self.__first_index += 1
+
+        if self.__metrics is not None:
+            self.__metrics.set_gauge(name=persizmq.metrics.QUEUE_DEPTH, value=len(self.__paths))
+
+    def consumers(self) -> List[str]:
+        """
+        :return: sorted names of the registered consumers
+        """
+        with self.__mu:
+            return sorted(self.__cursors.keys())
+
+    def add_consumer(self, consumer: str) -> None:
+        """
+        registers a new consumer at the oldest retained message. Does nothing if the consumer is already registered.
+
+        :param consumer: name of the consumer
+        """
+        with self.__mu:
+            if consumer not in self.__cursors:
+                self.__add_consumer(consumer=consumer)
+
+    def remove_consumer(self, consumer: str) -> None:
+        """
+        removes the consumer and deletes the messages which are no longer needed by any other consumer.
+
+        :param consumer: name of the consumer
+        """
+        with self.__mu:
+            cursor = self.__cursor(consumer=consumer)
+
+            self.__cursor_path(consumer=consumer).unlink()
+            del self.__cursors[consumer]
+            self.__evict(index=cursor)
+
+            self.__collect_garbage()
+
+    def front(self, consumer: str) -> Optional[bytes]:
+        """
+        makes a copy of the first message pending for the consumer, but does not advance the consumer's cursor.
+
+        :param consumer: name of the consumer
+        :return: copy of the message, or None if the consumer has read all the messages
+        """
+        with self.__mu:
+            cursor = self.__cursor(consumer=consumer)
+            if cursor >= self.__count:
+                return None
+
+            return copy.deepcopy(self.__message(index=cursor))
+
+    def front_object(self, consumer: str) -> Any:
+        """
+        decodes the first message pending for the consumer with the codec, but does not advance the consumer's
+        cursor. The message is decoded only once for all the consumers; do not modify the returned object.
+
+        :param consumer: name of the consumer
+        :return: decoded message, or None if the consumer has read all the messages
+        """
+        if self.__codec is None:
+            raise ValueError("No codec has been specified for the multi-consumer storage.")
+
+        with self.__mu:
+            cursor = self.__cursor(consumer=consumer)
+            if cursor >= self.__count:
+                return None
+
+            if cursor not in self.__decoded:
+                self.__decoded[cursor] = self.__codec.decode(self.__message(index=cursor))
+
+            return self.__decoded[cursor]
+
+    def pop_front(self, consumer: str) -> bool:
+        """
+        advances the consumer's cursor past its first pending message.
+
+        :param consumer: name of the consumer
+        :return: True if there was a message pending for the consumer
+        """
+        with self.__mu:
+            cursor = self.__cursor(consumer=consumer)
+            if cursor >= self.__count:
+                return False
+
+            with self.__cursor_path(consumer=consumer).open("r+b") as fid:
+                fid.write(struct.pack(_CURSOR_FORMAT, cursor + 1))
+            self.__cursors[consumer] = cursor + 1
+            self.__evict(index=cursor)
+
+            if self.__metrics is not None:
+                self.__metrics.increment(name=persizmq.metrics.POPPED)
+
+            self.__collect_garbage()
+            return True
+
+    def add_message(self, msg: Optional[bytes]) -> None:
+        """
+        adds a message to the queue of every consumer.
+
+        :param msg: message to be added
+        """
+        if msg is None:
+            persizmq._mark_filtered(metrics=self.__metrics)
+            return
+
+        with self.__mu:
+            self.__paths.append(
+                persizmq._write_message(
+                    persistent_dir=self.__persistent_dir, index=self.__count, msg=msg, metrics=self.__metrics))
+            self.__count += 1
+
+            if self.__metrics is not None:
+                self.__metrics.set_gauge(name=persizmq.metrics.QUEUE_DEPTH, value=len(self.__paths))
+
+    def add_object(self, obj: Any) -> None:
+        """
+        encodes the object with the codec and adds it to the queue of every consumer.
+
+        :param obj: object to be added
+        """
+        if self.__codec is None:
+            raise ValueError("No codec has been specified for the multi-consumer storage.")
+
+        self.add_message(self.__codec.encode(obj))
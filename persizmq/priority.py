@@ -0,0 +1,173 @@
+""" provides a persistent queue with priority levels. """
+
+import pathlib
+import threading
+from typing import Callable, Dict, List, Optional, Union  # pylint: disable=unused-import
+
+import persizmq
+
+
+class TopicPrefix:
+    """
+    classifies the messages by their topic prefix.
+    """
+
+    def __init__(self, levels: Dict[bytes, int], default: int) -> None:
+        """
+        :param levels: topic prefix -> priority level; the longest matching prefix wins
+        :param default: priority level of the messages without a matching prefix
+        """
+        self.levels = levels
+        self.default = default
+
+        self.__prefixes = sorted(levels.keys(), key=len, reverse=True)
+
+    def __call__(self, msg: bytes) -> int:
+        for prefix in self.__prefixes:
+            if msg.startswith(prefix):
+                return self.levels[prefix]
+
+        return self.default
+
+
+class PriorityStorage:
+    """
+    persists received messages on disk in a fixed number of FIFO queues, one per priority level.
+
+    Level 0 is the most urgent. front and pop_front always serve the most urgent non-empty level, so an urgent
+    message waits at most for the urgent messages added before it, never behind a backlog of less urgent ones. Each
+    level is a PersistentStorage with its own index in the subdirectory "level_<level>"; the most urgent non-empty
+    level is tracked as a bit mask, so it is found in constant time.
+
+    pop_front removes the message which the last front returned, even if a more urgent message has arrived in
+    the meanwhile. With more than one consumer, use pop, which reads and removes the message atomically.
+    """
+
+    def __init__(self,
+                 persistent_dir: Union[str, pathlib.Path],
+                 levels: int,
+                 classifier: Callable[[bytes], int]) -> None:
+        """
+        :param persistent_dir: directory where the levels are stored
+        :param levels: number of priority levels
+        :param classifier: maps a message to its priority level, e.g., TopicPrefix
+        """
+        if levels <= 0:
+            raise ValueError("Expected a positive number of levels, got: {}".format(levels))
+
+        persistent_pth = persizmq._to_path(persistent_dir=persistent_dir)  # pylint: disable=protected-access
+
+        self.classifier = classifier
+
+        self.__mu = threading.Lock()
+        # level of the message returned by the last front, if it has not been popped yet
+        self.__front_level = None  # type: Optional[int]
+        self.__levels = [
+            persizmq.PersistentStorage(persistent_dir=persistent_pth / "level_{}".format(level))
+            for level in range(levels)
+        ]
+
+        # bit i is set if the level i has pending messages
+        self.__non_empty = 0
+        for level, storage in enumerate(self.__levels):
+            if storage.size() > 0:
+                self.__non_empty |= 1 << level
+
+    def __most_urgent(self) -> Optional[int]:
+        """
+        :return: the most urgent non-empty level, if any; expects the caller to hold the lock
+        """
+        if self.__non_empty == 0:
+            return None
+
+        # isolate the lowest set bit
+        return (self.__non_empty & -self.__non_empty).bit_length() - 1
+
+    def __remove_first(self, level: int) -> None:
+        """
+        removes the first pending message of the level; expects the caller to hold the lock.
+
+        :param level: non-empty priority level
+        """
+        storage = self.__levels[level]
+        storage.pop_front()
+        if storage.size() == 0:
+            self.__non_empty &= ~(1 << level)
+
+        self.__front_level = None
+
+    def size(self, level: Optional[int] = None) -> int:
+        """
+        :param level: if set, only the messages of this level are counted
+        :return: number of pending messages
+        """
+        if level is not None:
+            return self.__levels[level].size()
+
+        return sum(storage.size() for storage in self.__levels)
+
+    def front(self) -> Optional[bytes]:
+        """
+        makes a copy of the first pending message of the most urgent non-empty level, but does not remove it.
+
+        :return: copy of the message, or None if no message in any level
+        """
+        with self.__mu:
+            level = self.__most_urgent()
+            self.__front_level = level
+            if level is None:
+                return None
+
+            return self.__levels[level].front()
+
+    def pop_front(self) -> bool:
+        """
+        removes the message returned by the last front, or the first pending message of the most urgent non-empty
+        level if front has not been called since the last removal.
+
+        :return: True if there was a message in any level
+        """
+        with self.__mu:
+            level = self.__front_level
+            if level is None or not self.__non_empty & (1 << level):
+                level = self.__most_urgent()
+
+            if level is None:
+                return False
+
+            self.__remove_first(level=level)
+            return True
+
+    def pop(self) -> Optional[bytes]:
+        """
+        atomically reads and removes the first pending message of the most urgent non-empty level. Use this method
+        if multiple consumers share the storage.
+
+        :return: the message, or None if no message in any level
+        """
+        with self.__mu:
+            level = self.__most_urgent()
+            if level is None:
+                return None
+
+            msg = self.__levels[level].front()
+            self.__remove_first(level=level)
+            return msg
+
+    def add_message(self, msg: Optional[bytes]) -> None:
+        """
+        adds the message to the queue of its priority level.
+
+        :param msg: message to be added
+        """
+        if msg is None:
+            return
+
+        level = self.classifier(msg)
+        if level < 0 or level >= len(self.__levels):
+            raise ValueError("Expected the classifier to return a level in [0, {}), got: {}".format(
+                len(self.__levels), level))
+
+        with self.__mu:
+            self.__levels[level].add_message(msg)
+            self.__non_empty |= 1 << level
@@ -0,0 +1,206 @@
+""" provides a publisher which persists the outgoing messages before sending them. """
+
+import contextlib
+import os
+import threading
+from typing import Callable, Optional  # pylint: disable=unused-import
+
+import zmq
+
+import persizmq
+import persizmq.metrics
+
+
+class PersistentPublisher:
+    """
+    persists outgoing messages in an outbox and sends them in a separate thread.
+
+    The producers only append to the outbox and never block on the network. The sending thread polls the socket for
+    writability and sends the pending messages with zmq.NOBLOCK until the socket would block, so the sending is paced
+    by the socket's high-water mark instead of sleeps. A message is removed from the outbox only after it has been
+    handed over to zeromq; the messages still in the outbox are sent after a restart.
+
+    Mind that PUB sockets are always writable and silently drop the messages at the high-water mark. Use a PUSH
+    socket (or a socket which blocks at the high-water mark) if no message may be lost on the way.
+
+    Do not share the socket between threads, see http://zguide.zeromq.org/py:chapter2#Multithreading-with-ZeroMQ
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self,
+                 publisher: zmq.Socket,
+                 outbox: persizmq.PersistentStorage,
+                 on_exception: Callable[[Exception], None],
+                 metrics: Optional[persizmq.metrics.Metrics] = None) -> None:
+        """
+        :param publisher: zeromq socket; only operated by PersistentPublisher, do not share among threads!
+        :param outbox: storage of the pending messages
+        :param on_exception: Is called when an exception occurs in the sending thread.
+        :param metrics: if set, counts the sent messages
+        """
+        if isinstance(publisher, zmq.Socket):
+            self._publisher = publisher
+        else:
+            raise TypeError("unexpected type of the argument publisher: {}".format(publisher.__class__.__name__))
+
+        self.outbox = outbox
+        self.on_exception = on_exception
+        self.operational = False
+        self.metrics = metrics
+
+        self._exit_stack = contextlib.ExitStack()
+
+        # notified every time the sending thread emptied a batch of messages from the outbox and when it stops
+        self._sent = threading.Condition()
+        self._stop = False
+
+        init_err = None  # type: Optional[Exception]
+
+        try:
+            # The producers wake up the sending thread through a pipe since zeromq sockets must not be shared
+            # among the threads.
+            self._wake_read, self._wake_write = os.pipe()
+            self._exit_stack.callback(os.close, self._wake_read)
+            self._exit_stack.callback(os.close, self._wake_write)
+            os.set_blocking(self._wake_read, False)
+            os.set_blocking(self._wake_write, False)
+
+            self._thread = threading.Thread(target=self._send_pending)
+            self._thread.start()
+            self.operational = True
+
+        except Exception as err:  # pylint: disable=broad-except
+            init_err = err
+
+        if init_err is not None:
+            self._exit_stack.close()
+            raise init_err  # pylint: disable=raising-bad-type
+
+    def _wake_up(self) -> None:
+        """
+        wakes up the sending thread.
+        """
+        try:
+            os.write(self._wake_write, b'\0')
+        except BlockingIOError:
+            # The pipe is full, so the sending thread is going to wake up anyhow.
+            pass
+
+    def _drain_wake_pipe(self) -> None:
+        """
+        reads all the pending wake-up signals from the pipe.
+        """
+        while True:
+            try:
+                if not os.read(self._wake_read, 4096):
+                    break
+            except BlockingIOError:
+                break
+
+    def _send_batch(self, msg: bytes) -> None:
+        """
+        sends the messages from the outbox until the outbox is empty or the socket would block.
+
+        :param msg: first message of the outbox
+        """
+        next_msg = msg  # type: Optional[bytes]
+        while next_msg is not None:
+            try:
+                self._publisher.send(next_msg, zmq.NOBLOCK)  # pylint: disable=no-member
+            except zmq.Again:
+                break
+
+            self.outbox.pop_front()
+            if self.metrics is not None:
+                self.metrics.increment(name=persizmq.metrics.SENT)
+
+            next_msg = self.outbox.front()
+
+    def _send_pending(self) -> None:
+        """
+        sends the messages from the outbox whenever the socket is writable. This function is expected to run in
+        a separate thread.
+        """
+        poller = zmq.Poller()
+        poller.register(self._wake_read, zmq.POLLIN)  # pylint: disable=no-member
+
+        # The socket is polled for writability only if there are pending messages; otherwise, the poll would
+        # return immediately.
+        registered = False
+
+        try:
+            while True:
+                msg = self.outbox.front()
+
+                if msg is None:
+                    with self._sent:
+                        self._sent.notify_all()
+
+                    if registered:
+                        poller.unregister(self._publisher)
+                        registered = False
+
+                elif not registered:
+                    poller.register(self._publisher, zmq.POLLOUT)  # pylint: disable=no-member
+                    registered = True
+
+                socks = dict(poller.poll())
+
+                if self._wake_read in socks:
+                    self._drain_wake_pipe()
+                    if self._stop:
+                        break
+
+                if msg is not None and socks.get(self._publisher, 0) & zmq.POLLOUT:  # pylint: disable=no-member
+                    self._send_batch(msg=msg)
+
+        except Exception as err:  # pylint: disable=broad-except
+            self.on_exception(err)
+
+        finally:
+            # Wake up the waiting flushes since the outbox is not going to be emptied any more.
+            with self._sent:
+                self._stop = True
+                self._sent.notify_all()
+
+    def send(self, msg: Optional[bytes]) -> None:
+        """
+        persists the message in the outbox and schedules it for sending. Does not block on the network.
+
+        :param msg: message to be sent; None is ignored so that filters can be chained
+        """
+        self.outbox.add_message(msg)
+        if msg is not None:
+            self._wake_up()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        waits until the outbox is empty. Returns early if the sending thread stopped due to an exception or
+        a shutdown.
+
+        :param timeout: maximum time to wait in seconds; None waits forever
+        :return: True if the outbox has been emptied within the timeout
+        """
+        with self._sent:
+            return self._sent.wait_for(lambda: self._stop or self.outbox.front() is None, timeout=timeout) \
+                and self.outbox.front() is None
+
+    def shutdown(self) -> None:
+        """
+        stops the sending thread. The messages which have not been sent yet remain in the outbox.
+        """
+        if self.operational:
+            self._stop = True
+            self._wake_up()
+            self._thread.join()
+            self._exit_stack.close()
+
+        self.operational = False
+
+    def __enter__(self) -> 'PersistentPublisher':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.operational:
+            self.shutdown()
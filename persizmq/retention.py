@@ -0,0 +1,74 @@
+""" provides the enforcement of retention policies on the persistent storage. """
+
+import threading
+from typing import Callable, Optional  # pylint: disable=unused-import
+
+import persizmq
+
+
+class Janitor:
+    """
+    periodically removes the pending messages of a persistent storage which are older than max_age or exceed
+    max_bytes in a separate thread.
+
+    The janitor only inspects the sizes and the receive times that the storage keeps in memory, so it never lists
+    the persistent directory.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self,
+                 storage: persizmq.PersistentStorage,
+                 on_exception: Callable[[Exception], None],
+                 max_age: Optional[float] = None,
+                 max_bytes: Optional[int] = None,
+                 period: float = 1.0) -> None:
+        """
+        :param storage: whose messages are to be expired
+        :param on_exception: Is called when an exception occurs in the janitor's thread.
+        :param max_age: if set, messages received more than max_age seconds ago are removed
+        :param max_bytes: if set, the oldest messages are removed until the pending messages fit in max_bytes
+        :param period: time in seconds between two enforcements of the retention policy
+        """
+        if max_age is None and max_bytes is None:
+            raise ValueError("Expected at least max_age or max_bytes to be set.")
+
+        self.storage = storage
+        self.on_exception = on_exception
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.period = period
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.start()
+        self.operational = True
+
+    def _run(self) -> None:
+        """
+        enforces the retention policy until the janitor is shut down. This function is expected to run in a separate
+        thread.
+        """
+        while not self._stop.wait(timeout=self.period):
+            try:
+                self.storage.expire(max_age=self.max_age, max_bytes=self.max_bytes)
+            except Exception as err:  # pylint: disable=broad-except
+                self.on_exception(err)
+                break
+
+    def shutdown(self) -> None:
+        """
+        stops the janitor's thread.
+        """
+        if self.operational:
+            self._stop.set()
+            self._thread.join()
+
+        self.operational = False
+
+    def __enter__(self) -> 'Janitor':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.operational:
+            self.shutdown()
@@ -0,0 +1,262 @@
+""" provides a persistent queue striped across multiple directories. """
+
+# pylint: disable=protected-access
+
+import collections
+import copy
+import heapq
+import pathlib
+import queue
+import threading
+from typing import Dict, List, Optional, Set, Tuple, Union  # pylint: disable=unused-import
+
+import persizmq
+
+# number of sequence numbers reserved at once in the sequence files of the shards
+_RESERVATION = 1024
+
+
+class ShardedStorage:
+    """
+    persists received messages in a FIFO queue striped across multiple directories (e.g., on separate disks).
+
+    Every message is assigned a global sequence number and written to the shard (sequence number modulo the number
+    of shards) by the shard's own writer thread, so the shards are written in parallel. add_message only enqueues
+    the message; a message becomes visible to front only after it and all the messages before it have been written,
+    so the FIFO order is kept. Use flush to wait until all the added messages are on disk; the messages still queued
+    for writing are lost on a crash.
+
+    On restart, the sorted listings of the shards are merged by the sequence numbers, so the number of shards may
+    change between restarts. Every shard records how far the sequence numbers have been handed out in its "sequence"
+    file, so the sequence numbers are never reused even if a shard is left out on restart. The messages of a left-out
+    shard are only recovered once its directory is passed again.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, persistent_dirs: List[Union[str, pathlib.Path]], queue_size: int = 1024) -> None:
+        """
+        :param persistent_dirs: directories of the shards
+        :param queue_size: maximum number of messages queued for writing per shard; add_message blocks when reached
+        """
+        if not persistent_dirs:
+            raise ValueError("Expected at least one persistent directory.")
+
+        self.__dirs = [persizmq._to_path(persistent_dir=persistent_dir) for persistent_dir in persistent_dirs]
+        for persistent_dir in self.__dirs:
+            persistent_dir.mkdir(exist_ok=True, parents=True)
+
+        self.__mu = threading.Lock()
+        self.__written_cond = threading.Condition(self.__mu)
+
+        # sequence number -> path of the readable messages
+        self.__paths = dict()  # type: Dict[int, pathlib.Path]
+
+        # sequence numbers of the readable messages in FIFO order
+        self.__pending = collections.deque()  # type: collections.deque
+
+        self.__first = None  # type: Optional[bytes]
+
+        listings = []  # type: List[List[Tuple[int, pathlib.Path]]]
+        count = 0
+        for persistent_dir in self.__dirs:
+            paths, shard_count = persizmq._recover_messages(persistent_dir=persistent_dir)
+            listings.append([(int(pth.stem), pth) for pth in paths])
+            count = max(count, shard_count, ShardedStorage.__read_reserved(persistent_dir=persistent_dir))
+
+        for index, pth in heapq.merge(*listings):
+            if index in self.__paths:
+                raise ValueError("Expected each sequence number in only one shard, but found {!r} and {!r}".format(
+                    str(self.__paths[index]), str(pth)))
+
+            self.__paths[index] = pth
+            self.__pending.append(index)
+
+        # sequence number of the next message to be added
+        self.__count = count
+
+        # sequence numbers before this one may be handed out without updating the sequence files
+        self.__reserved = count
+
+        # all the messages before this sequence number have been written
+        self.__written_end = count
+
+        # sequence numbers of the messages written out of order
+        self.__written = set()  # type: Set[int]
+
+        self.__error = None  # type: Optional[Exception]
+
+        self.__queues = []  # type: List[queue.Queue]
+        self.__threads = []  # type: List[threading.Thread]
+        for persistent_dir in self.__dirs:
+            write_queue = queue.Queue(maxsize=queue_size)  # type: queue.Queue
+            thread = threading.Thread(target=self.__write, args=(persistent_dir, write_queue))
+            thread.start()
+
+            self.__queues.append(write_queue)
+            self.__threads.append(thread)
+
+        self.operational = True
+
+    @staticmethod
+    def __read_reserved(persistent_dir: pathlib.Path) -> int:
+        """
+        :param persistent_dir: directory of a shard
+        :return: sequence number up to which the sequence numbers might have been handed out, 0 if not recorded
+        """
+        pth = persistent_dir / "sequence"
+        if not pth.exists():
+            return 0
+
+        text = pth.read_text()
+        if not text.isdigit():
+            raise ValueError("Failed to load the sequence number from the file {!r}.".format(str(pth)))
+
+        return int(text)
+
+    def __reserve(self) -> None:
+        """
+        records the next reservation of sequence numbers in all the shards. Expects the caller to hold the lock.
+        """
+        reserved = self.__count + _RESERVATION
+        for persistent_dir in self.__dirs:
+            persizmq._write_atomically(path=persistent_dir / "sequence", data=str(reserved).encode())
+
+        self.__reserved = reserved
+
+    def __write(self, persistent_dir: pathlib.Path, write_queue: queue.Queue) -> None:
+        """
+        writes the queued messages of a shard. This function is expected to run in a separate thread.
+
+        :param persistent_dir: directory of the shard
+        :param write_queue: messages of the shard as (sequence number, message); None stops the thread
+        """
+        while True:
+            item = write_queue.get()
+            if item is None:
+                break
+
+            index, msg = item
+            pth = persizmq._message_path(persistent_dir=persistent_dir, index=index)
+
+            error = None  # type: Optional[Exception]
+            try:
+                persizmq._write_atomically(path=pth, data=msg)
+            except Exception as err:  # pylint: disable=broad-except
+                error = err
+
+            with self.__written_cond:
+                if error is None:
+                    self.__paths[index] = pth
+                else:
+                    # The message is lost; skip it so that the following messages do not wait for it forever.
+                    self.__error = error
+
+                self.__written.add(index)
+
+                while self.__written_end in self.__written:
+                    self.__written.remove(self.__written_end)
+                    if self.__written_end in self.__paths:
+                        self.__pending.append(self.__written_end)
+                    self.__written_end += 1
+
+                self.__written_cond.notify_all()
+
+    def __raise_error(self) -> None:
+        """
+        re-raises the exception which occurred in a writer thread. Expects the caller to hold the lock.
+        """
+        if self.__error is not None:
+            error = self.__error
+            self.__error = None
+            raise error
+
+    def front(self) -> Optional[bytes]:
+        """
+        makes a copy of the first pending message, but does not remove it from the queue.
+
+        :return: copy of the first message, or None if no written message in the queue
+        """
+        with self.__mu:
+            if not self.__pending:
+                return None
+
+            if self.__first is None:
+                self.__first = self.__paths[self.__pending[0]].read_bytes()
+
+            return copy.deepcopy(self.__first)
+
+    def pop_front(self) -> bool:
+        """
+        removes a message from the queue.
+
+        :return: True if there was a written message in the queue
+        """
+        with self.__mu:
+            if not self.__pending:
+                return False
+
+            self.__paths.pop(self.__pending.popleft()).unlink()
+            self.__first = None
+            return True
+
+    def add_message(self, msg: Optional[bytes]) -> None:
+        """
+        queues the message for writing to its shard.
+
+        :param msg: message to be added
+        """
+        if msg is None:
+            return
+
+        with self.__mu:
+            if not self.operational:
+                raise RuntimeError("The sharded storage has been closed.")
+
+            self.__raise_error()
+
+            if self.__count >= self.__reserved:
+                self.__reserve()
+
+            index = self.__count
+            self.__count += 1
+
+        # Put outside of the lock since it blocks if the writer of the shard lags behind.
+        self.__queues[index % len(self.__queues)].put((index, msg))
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        waits until all the added messages have been written. Re-raises the exception if a message could not be
+        written.
+
+        :param timeout: maximum time to wait in seconds; None waits forever
+        :return: True if all the messages have been written within the timeout
+        """
+        with self.__written_cond:
+            result = self.__written_cond.wait_for(
+                lambda: self.__error is not None or self.__written_end == self.__count, timeout=timeout)
+
+            self.__raise_error()
+            return result
+
+    def close(self) -> None:
+        """
+        writes all the queued messages and stops the writer threads. Do not call it while other threads are still
+        adding messages.
+        """
+        with self.__mu:
+            if not self.operational:
+                return
+            self.operational = False
+
+        for write_queue in self.__queues:
+            write_queue.put(None)
+
+        for thread in self.__threads:
+            thread.join()
+
+    def __enter__(self) -> 'ShardedStorage':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,337 @@
+""" provides a persistent queue which can be shared among multiple processes. """
+
+# pylint: disable=protected-access
+
+import contextlib
+import copy
+import fcntl
+import itertools
+import mmap
+import os
+import pathlib
+import struct
+import threading
+import time
+from typing import Any, Iterator, Optional, Tuple, Union  # pylint: disable=unused-import
+
+import persizmq
+import persizmq.codec
+import persizmq.metrics
+
+# head (sequence number of the first pending message) and tail (sequence number of the next message to be added)
+_INDEX_FORMAT = "<QQ"
+_INDEX_SIZE = struct.calcsize(_INDEX_FORMAT)
+
+
+class SharedStorage:
+    """
+    persists received messages on disk in a FIFO queue which is safe to share among multiple processes.
+
+    The head and the tail of the queue live in a memory-mapped index file which is only modified under an exclusive
+    fcntl lock on the lock file. A message is written to a temporary file outside of the lock and merely renamed
+    under the lock, so that the producers do not serialize on the disk writes.
+
+    Use pop to consume the queue from more than one process: a front followed by a pop_front is not atomic
+    across processes.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self,
+                 persistent_dir: Union[str, pathlib.Path],
+                 metrics: Optional[persizmq.metrics.Metrics] = None,
+                 codec: Optional[persizmq.codec.Codec] = None) -> None:
+        """
+        :param persistent_dir: directory where the messages are stored; shared with the other processes
+        :param metrics: if set, counts the filtered, persisted and popped messages
+        :param codec: if set, enables front_object, pop_object and add_object
+        """
+        self.__persistent_dir = persizmq._to_path(persistent_dir=persistent_dir)
+        self.__persistent_dir.mkdir(exist_ok=True, parents=True)
+
+        self.__metrics = metrics
+        self.__codec = codec
+
+        # fcntl locks exclude other processes, but not the other threads of this process.
+        self.__mu = threading.Lock()
+        self.__tmp_counter = itertools.count()
+
+        # cached copy of the first message, valid as long as the head equals __first_index
+        self.__first = None  # type: Optional[bytes]
+        self.__first_index = -1
+        self.__first_decoded = None  # type: Any
+        self.__first_is_decoded = False
+
+        self.__exit_stack = contextlib.ExitStack()
+
+        init_err = None  # type: Optional[Exception]
+        try:
+            self.__lock_file = self.__exit_stack.enter_context((self.__persistent_dir / "lock").open("a+b"))
+
+            with self.__locked():
+                index_pth = self.__persistent_dir / "index"
+                if not index_pth.exists():
+                    paths, count = persizmq._recover_messages(persistent_dir=self.__persistent_dir)
+                    head = int(paths[0].stem) if paths else count
+                    persizmq._write_atomically(path=index_pth, data=struct.pack(_INDEX_FORMAT, head, count))
+
+                self.__index_file = self.__exit_stack.enter_context(index_pth.open("r+b"))
+                self.__index = mmap.mmap(self.__index_file.fileno(), _INDEX_SIZE)
+                self.__exit_stack.callback(self.__index.close)
+
+                self.__remove_orphaned_tmp_files()
+                self.__remove_orphaned_messages()
+
+        except Exception as err:  # pylint: disable=broad-except
+            init_err = err
+
+        if init_err is not None:
+            self.__exit_stack.close()
+            raise init_err  # pylint: disable=raising-bad-type
+
+    @contextlib.contextmanager
+    def __locked(self) -> Iterator[None]:
+        """
+        holds the lock against the other threads and the other processes.
+        """
+        with self.__mu:
+            fcntl.flock(self.__lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.__lock_file.fileno(), fcntl.LOCK_UN)
+
+    def __remove_orphaned_tmp_files(self) -> None:
+        """
+        removes the temporary files left over by the processes which are no longer running. Expects the caller to
+        hold the lock.
+        """
+        for pth in self.__persistent_dir.glob("*.tmp"):
+            pid_str = pth.name.split("-")[0]
+            if not pid_str.isdigit():
+                pth.unlink()
+                continue
+
+            try:
+                os.kill(int(pid_str), 0)
+            except ProcessLookupError:
+                pth.unlink()
+            except PermissionError:
+                # The process exists, but belongs to somebody else.
+                pass
+
+    def __remove_orphaned_messages(self) -> None:
+        """
+        removes the message files before the head which a crash left behind between advancing the head and
+        unlinking the file. Expects the caller to hold the lock.
+        """
+        head, _ = self.__read_index()
+        for pth in self.__persistent_dir.glob("*.bin"):
+            if pth.stem.isdigit() and int(pth.stem) < head:
+                pth.unlink()
+
+    def __read_index(self) -> Tuple[int, int]:
+        """
+        :return: head and tail of the queue; expects the caller to hold the lock
+        """
+        head, tail = struct.unpack(_INDEX_FORMAT, self.__index[:_INDEX_SIZE])
+        return head, tail
+
+    def __write_index(self, head: int, tail: int) -> None:
+        """
+        updates the head and the tail of the queue; expects the caller to hold the lock.
+
+        :param head: sequence number of the first pending message
+        :param tail: sequence number of the next message to be added
+        """
+        self.__index[:_INDEX_SIZE] = struct.pack(_INDEX_FORMAT, head, tail)
+
+    def __read_first(self, head: int) -> bytes:
+        """
+        :param head: sequence number of the first pending message
+        :return: the first pending message, cached as long as the head does not change; expects the caller to hold
+            the lock
+        """
+        if self.__first is None or self.__first_index != head:
+            self.__first = persizmq._message_path(persistent_dir=self.__persistent_dir, index=head).read_bytes()
+            self.__first_index = head
+            self.__first_decoded = None
+            self.__first_is_decoded = False
+
+        return self.__first
+
+    def __decode_first(self, head: int) -> Any:
+        """
+        :param head: sequence number of the first pending message
+        :return: the first pending message decoded with the codec, cached as long as the head does not change;
+            expects the caller to hold the lock
+        """
+        assert self.__codec is not None
+
+        msg = self.__read_first(head=head)
+        if not self.__first_is_decoded:
+            self.__first_decoded = self.__codec.decode(msg)
+            self.__first_is_decoded = True
+
+        return self.__first_decoded
+
+    def __remove_first(self, head: int, tail: int) -> None:
+        """
+        removes the first pending message; expects the caller to hold the lock.
+
+        :param head: sequence number of the first pending message
+        :param tail: sequence number of the next message to be added
+        """
+        # Advance the head before unlinking so that a crash in between leaves an orphaned file rather than
+        # a head pointing to a missing file.
+        self.__write_index(head=head + 1, tail=tail)
+        persizmq._message_path(persistent_dir=self.__persistent_dir, index=head).unlink()
+
+        self.__first = None
+        self.__first_index = -1
+        self.__first_decoded = None
+        self.__first_is_decoded = False
+
+        if self.__metrics is not None:
+            self.__metrics.increment(name=persizmq.metrics.POPPED)
+            self.__metrics.set_gauge(name=persizmq.metrics.QUEUE_DEPTH, value=tail - head - 1)
+
+    def size(self) -> int:
+        """
+        :return: number of pending messages in the queue as seen by all the processes
+        """
+        with self.__locked():
+            head, tail = self.__read_index()
+            return tail - head
+
+    def front(self) -> Optional[bytes]:
+        """
+        makes a copy of the first pending message, but does not remove it from the queue.
+
+        :return: copy of the first message, or None if no message in the queue
+        """
+        with self.__locked():
+            head, tail = self.__read_index()
+            if head == tail:
+                return None
+
+            return copy.deepcopy(self.__read_first(head=head))
+
+    def front_object(self) -> Any:
+        """
+        decodes the first pending message with the codec, but does not remove it from the queue. The message is
+        decoded only once per process; the subsequent calls return the same object, so do not modify it.
+
+        :return: decoded first message, or None if no message in the queue
+        """
+        if self.__codec is None:
+            raise ValueError("No codec has been specified for the shared storage.")
+
+        with self.__locked():
+            head, tail = self.__read_index()
+            if head == tail:
+                return None
+
+            return self.__decode_first(head=head)
+
+    def pop_front(self) -> bool:
+        """
+        removes a message from the queue.
+
+        :return: True if there was a message in the queue
+        """
+        with self.__locked():
+            head, tail = self.__read_index()
+            if head == tail:
+                return False
+
+            self.__remove_first(head=head, tail=tail)
+            return True
+
+    def pop(self) -> Optional[bytes]:
+        """
+        atomically reads and removes the first pending message. Use this method if multiple processes consume
+        the queue.
+
+        :return: the first message, or None if no message in the queue
+        """
+        with self.__locked():
+            head, tail = self.__read_index()
+            if head == tail:
+                return None
+
+            msg = self.__read_first(head=head)
+            self.__remove_first(head=head, tail=tail)
+            return msg
+
+    def pop_object(self) -> Any:
+        """
+        atomically reads, decodes and removes the first pending message. Use this method if multiple processes
+        consume the queue.
+
+        :return: the decoded first message, or None if no message in the queue
+        """
+        if self.__codec is None:
+            raise ValueError("No codec has been specified for the shared storage.")
+
+        with self.__locked():
+            head, tail = self.__read_index()
+            if head == tail:
+                return None
+
+            obj = self.__decode_first(head=head)
+            self.__remove_first(head=head, tail=tail)
+            return obj
+
+    def add_message(self, msg: Optional[bytes]) -> None:
+        """
+        adds a message to the queue.
+
+        :param msg: message to be added
+        """
+        if msg is None:
+            persizmq._mark_filtered(metrics=self.__metrics)
+            return
+
+        start = time.monotonic() if self.__metrics is not None else 0.0
+
+        tmp_pth = self.__persistent_dir / "{}-{}-{}.tmp".format(os.getpid(), threading.get_ident(),
+                                                                next(self.__tmp_counter))
+        try:
+            tmp_pth.write_bytes(msg)
+
+            with self.__locked():
+                head, tail = self.__read_index()
+                tmp_pth.rename(persizmq._message_path(persistent_dir=self.__persistent_dir, index=tail))
+                self.__write_index(head=head, tail=tail + 1)
+
+            if self.__metrics is not None:
+                self.__metrics.mark_persisted(write_duration=time.monotonic() - start)
+                self.__metrics.set_gauge(name=persizmq.metrics.QUEUE_DEPTH, value=tail + 1 - head)
+
+        finally:
+            if tmp_pth.exists():
+                tmp_pth.unlink()
+
+    def add_object(self, obj: Any) -> None:
+        """
+        encodes the object with the codec and adds it to the queue.
+
+        :param obj: object to be added
+        """
+        if self.__codec is None:
+            raise ValueError("No codec has been specified for the shared storage.")
+
+        self.add_message(self.__codec.encode(obj))
+
+    def close(self) -> None:
+        """
+        closes the index and the lock file. The messages remain on disk.
+        """
+        self.__exit_stack.close()
+
+    def __enter__(self) -> 'SharedStorage':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,339 @@
+""" provides an asynchronous writer which decouples the disk writes from the receiving thread. """
+
+import collections
+import pathlib
+import struct
+import threading
+import time
+from typing import BinaryIO, Callable, List, Optional, Union  # pylint: disable=unused-import
+
+import persizmq
+import persizmq.metrics
+
+# What AsyncWriter.add_message does when the queue is full:
+BLOCK = "block"  # wait until the writer thread frees up space
+DROP = "drop"  # discard the message
+SPILL = "spill"  # append the message to the spill log
+
+_RECORD_HEADER = "<I"
+_RECORD_HEADER_SIZE = struct.calcsize(_RECORD_HEADER)
+
+
+def _read_spill_log(path: pathlib.Path) -> List[bytes]:
+    """
+    :param path: to the spill log
+    :return: messages of the spill log; a partially written record at the end is ignored
+    """
+    data = path.read_bytes()
+
+    msgs = []  # type: List[bytes]
+    offset = 0
+    while offset + _RECORD_HEADER_SIZE <= len(data):
+        size, = struct.unpack_from(_RECORD_HEADER, data, offset)
+        offset += _RECORD_HEADER_SIZE
+        if offset + size > len(data):
+            break
+
+        msgs.append(data[offset:offset + size])
+        offset += size
+
+    return msgs
+
+
+class AsyncWriter:
+    """
+    writes the messages to a persistent storage in a separate thread.
+
+    add_message only puts the message in a bounded in-memory queue, so a slow disk does not stall the thread
+    receiving from zeromq. The writer thread takes up to max_batch queued messages at once and adds them to the
+    storage as one batch.
+
+    When the queue is full, add_message blocks, drops the message or spills it, depending on when_full. Spilled
+    messages are appended to a sequential spill log, which is much cheaper than writing a message file; the writer
+    thread moves them to the storage once the queue has been written. The spill log is read back on restart. As long
+    as spilled messages are pending, new messages are spilled as well so that the order is kept.
+
+    Neither the spill log nor the storage's message files are fsynced: the data is handed to the operating system,
+    so it survives a crash of the process, but not necessarily a crash of the machine or a power loss.
+
+    The messages in the queue are lost on a crash; use flush to wait until they are in the storage. The spilled
+    messages are delivered at least once: the spill log is moved to the storage in batches of max_batch messages and
+    the progress is recorded after each batch, so a crash while moving them adds at most one batch twice.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self,
+                 storage: persizmq.PersistentStorage,
+                 on_exception: Callable[[Exception], None],
+                 queue_size: int = 1024,
+                 when_full: str = BLOCK,
+                 spill_dir: Union[None, str, pathlib.Path] = None,
+                 max_batch: int = 256,
+                 metrics: Optional[persizmq.metrics.Metrics] = None) -> None:
+        """
+        :param storage: where the messages are written to
+        :param on_exception: Is called when an exception occurs in the writer thread; the writer stops afterwards.
+        :param queue_size: maximum number of queued messages
+        :param when_full: BLOCK, DROP or SPILL
+        :param spill_dir: directory of the spill log; required for SPILL
+        :param max_batch: maximum number of messages written as one batch
+        :param metrics:
+            if set, counts the dropped and spilled messages, tracks the queue depth and records the latency from
+            the reception until the message is written to the storage or the spill log
+        """
+        # pylint: disable=too-many-arguments
+        if when_full not in [BLOCK, DROP, SPILL]:
+            raise ValueError("Unexpected when_full: {!r}".format(when_full))
+
+        if queue_size <= 0 or max_batch <= 0:
+            raise ValueError("Expected positive queue_size and max_batch, got: {} and {}".format(
+                queue_size, max_batch))
+
+        self.storage = storage
+        self.on_exception = on_exception
+        self.queue_size = queue_size
+        self.when_full = when_full
+        self.max_batch = max_batch
+        self.metrics = metrics
+
+        self.__spill_log = None  # type: Optional[pathlib.Path]
+        self.__spill_draining = None  # type: Optional[pathlib.Path]
+        self.__spill_progress = None  # type: Optional[pathlib.Path]
+
+        if spill_dir is not None:
+            spill_pth = persizmq._to_path(persistent_dir=spill_dir)  # pylint: disable=protected-access
+            spill_pth.mkdir(exist_ok=True, parents=True)
+            self.__spill_log = spill_pth / "spill.log"
+            self.__spill_draining = spill_pth / "spill.draining"
+            self.__spill_progress = spill_pth / "spill.progress"
+
+            # Recover the messages spilled before a restart in their order.
+            if not self.__spill_draining.exists() and self.__spill_progress.exists():
+                # The crash happened after the draining log had been removed.
+                self.__spill_progress.unlink()
+
+            if self.__spill_draining.exists():
+                self.__drain()
+
+            if self.__spill_log.exists():
+                self.__spill_log.rename(self.__spill_draining)
+                self.__drain()
+
+        elif when_full == SPILL:
+            raise ValueError("Expected spill_dir to be set if when_full is SPILL.")
+
+        self.__cond = threading.Condition()
+        self.__queue = collections.deque()  # type: collections.deque
+        self.__spill_file = None  # type: Optional[BinaryIO]
+        self.__spilled = 0  # number of messages in the spill log
+        self.__draining = False  # True while the writer moves the spill log to the storage
+        self.__in_flight = 0  # number of messages taken from the queue, but not yet written
+        self.__stop = False
+
+        self.__thread = threading.Thread(target=self.__write)
+        self.__thread.start()
+        self.operational = True
+
+    def __observe_received(self, received_at: Optional[float]) -> None:
+        """
+        records the latency from the reception until the message has been written.
+
+        :param received_at: monotonic time of the reception, if marked
+        """
+        if self.metrics is not None and received_at is not None:
+            self.metrics.observe(name=persizmq.metrics.RECV_TO_PERSIST, seconds=time.monotonic() - received_at)
+
+    def __drain(self) -> None:
+        """
+        moves the messages from the draining spill log to the storage and removes the log. The number of moved
+        messages is recorded after every batch, so that a restart resumes after the last recorded batch.
+        """
+        # pylint: disable=protected-access
+        assert self.__spill_draining is not None and self.__spill_progress is not None
+
+        done = 0
+        if self.__spill_progress.exists():
+            text = self.__spill_progress.read_text()
+            if not text.isdigit():
+                raise ValueError("Failed to load the drain progress from the file {!r}.".format(
+                    str(self.__spill_progress)))
+            done = int(text)
+
+        spilled = _read_spill_log(path=self.__spill_draining)
+        for start in range(done, len(spilled), self.max_batch):
+            end = min(start + self.max_batch, len(spilled))
+            self.storage.add_messages(msgs=spilled[start:end])
+            persizmq._write_atomically(path=self.__spill_progress, data=str(end).encode())
+
+        # Remove the log first; a progress file without a log is discarded on restart.
+        self.__spill_draining.unlink()
+        if self.__spill_progress.exists():
+            self.__spill_progress.unlink()
+
+    def __spill(self, msg: bytes, received_at: Optional[float]) -> None:
+        """
+        appends the message to the spill log. Expects the caller to hold the lock.
+
+        :param msg: to be spilled
+        :param received_at: monotonic time of the reception, if marked
+        """
+        if self.__spill_file is None:
+            assert self.__spill_log is not None
+            self.__spill_file = self.__spill_log.open("ab")
+
+        self.__spill_file.write(struct.pack(_RECORD_HEADER, len(msg)))
+        self.__spill_file.write(msg)
+        self.__spill_file.flush()
+        self.__spilled += 1
+
+        if self.metrics is not None:
+            self.metrics.increment(name=persizmq.metrics.SPILLED)
+            self.__observe_received(received_at=received_at)
+
+    def __rotate_spill_log(self) -> None:
+        """
+        closes the spill log and renames it to the draining log. Expects the caller to hold the lock.
+        """
+        assert self.__spill_file is not None and self.__spill_log is not None
+        assert self.__spill_draining is not None
+
+        self.__spill_file.close()
+        self.__spill_file = None
+        self.__spill_log.rename(self.__spill_draining)
+        self.__spilled = 0
+
+    def __idle(self) -> bool:
+        """
+        :return: True if all the added messages have been written; expects the caller to hold the lock
+        """
+        return not self.__queue and self.__spilled == 0 and not self.__draining and self.__in_flight == 0
+
+    def __write(self) -> None:
+        """
+        writes the queued and the spilled messages. This function is expected to run in a separate thread.
+        """
+        while True:
+            batch = []  # type: List[bytes]
+            received = []  # type: List[Optional[float]]
+            drain = False
+
+            with self.__cond:
+                self.__cond.wait_for(lambda: self.__queue or self.__spilled > 0 or self.__stop)
+
+                if self.__queue:
+                    while self.__queue and len(batch) < self.max_batch:
+                        received_at, msg = self.__queue.popleft()
+                        batch.append(msg)
+                        received.append(received_at)
+                    self.__in_flight = len(batch)
+
+                elif self.__spilled > 0:
+                    # The queue is empty, so all the messages older than the spilled ones have been written.
+                    # The messages spilled until the log is rotated below are drained along.
+                    self.__draining = True
+                    drain = True
+
+                else:
+                    # stopped and everything has been written
+                    break
+
+                if self.metrics is not None:
+                    self.metrics.set_gauge(name=persizmq.metrics.WRITE_QUEUE_DEPTH, value=len(self.__queue))
+
+                self.__cond.notify_all()
+
+            try:
+                if drain:
+                    with self.__cond:
+                        self.__rotate_spill_log()
+
+                    self.__drain()
+                else:
+                    self.storage.add_messages(msgs=batch)
+                    for received_at in received:
+                        self.__observe_received(received_at=received_at)
+
+            except Exception as err:  # pylint: disable=broad-except
+                with self.__cond:
+                    self.operational = False
+                    self.__stop = True
+                    self.__cond.notify_all()
+
+                self.on_exception(err)
+                break
+
+            with self.__cond:
+                self.__in_flight = 0
+                self.__draining = False
+                self.__cond.notify_all()
+
+    def add_message(self, msg: Optional[bytes]) -> None:
+        """
+        queues the message for writing.
+
+        :param msg: message to be added; None is ignored so that filters can be chained
+        """
+        if msg is None:
+            return
+
+        # The message is written in another thread, so the reception mark of this thread is carried along.
+        received_at = self.metrics.take_received() if self.metrics is not None else None
+
+        with self.__cond:
+            if self.__stop:
+                raise RuntimeError("The asynchronous writer has been shut down.")
+
+            if self.__spilled > 0 or self.__draining:
+                self.__spill(msg=msg, received_at=received_at)
+                return
+
+            if len(self.__queue) >= self.queue_size:
+                if self.when_full == DROP:
+                    if self.metrics is not None:
+                        self.metrics.increment(name=persizmq.metrics.DROPPED)
+                    return
+
+                if self.when_full == SPILL:
+                    self.__spill(msg=msg, received_at=received_at)
+                    self.__cond.notify_all()
+                    return
+
+                self.__cond.wait_for(lambda: len(self.__queue) < self.queue_size or self.__stop)
+                if self.__stop:
+                    raise RuntimeError("The asynchronous writer has been shut down.")
+
+            self.__queue.append((received_at, msg))
+            self.__cond.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        waits until all the added messages have been written to the storage. The messages are then handed to
+        the operating system, but not fsynced.
+
+        :param timeout: maximum time to wait in seconds; None waits forever
+        :return: True if all the messages have been written within the timeout
+        """
+        with self.__cond:
+            return self.__cond.wait_for(lambda: self.__idle() or not self.operational, timeout=timeout) \
+                and self.__idle()
+
+    def shutdown(self) -> None:
+        """
+        writes all the pending messages and stops the writer thread.
+        """
+        if self.operational:
+            with self.__cond:
+                self.__stop = True
+                self.__cond.notify_all()
+
+            self.__thread.join()
+
+        self.operational = False
+
+    def __enter__(self) -> 'AsyncWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.operational:
+            self.shutdown()
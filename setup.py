@@ -35,7 +35,8 @@ setup(
     install_requires=['pyzmq>=16.0.4'],
     extras_require={
         'dev': ['mypy==0.600', 'pylint==1.8.4', 'yapf==0.20.2', 'tox>=3.0.0'],
-        'test': ['tox>=3.0.0']
+        'test': ['tox>=3.0.0'],
+        'msgpack': ['msgpack>=0.5.6']
     },
     py_modules=['persizmq'],
     package_data={"persizmq": ["py.typed"]})
@@ -1,18 +1,33 @@
 #!/usr/bin/env python3
 
-# pylint: disable=missing-docstring,too-many-public-methods
+# pylint: disable=missing-docstring,too-many-public-methods,too-many-lines
+import multiprocessing
 import pathlib
 import shutil
+import struct
 import tempfile
+import threading
 import time
 import unittest
+import unittest.mock
 import uuid
-from typing import List, Optional  # pylint: disable=unused-import
+from typing import List, Optional, Sequence  # pylint: disable=unused-import
 
 import zmq
 
 import persizmq
+import persizmq.codec
 import persizmq.filter
+import persizmq.hybrid
+import persizmq.lease
+import persizmq.metrics
+import persizmq.multiconsumer
+import persizmq.priority
+import persizmq.publisher
+import persizmq.retention
+import persizmq.sharded
+import persizmq.shared
+import persizmq.writer
 
 
 class TestContext:
@@ -266,6 +281,79 @@ class TestPersistentSubscriber(unittest.TestCase):
                         self.assertEqual("{}".format(i).encode(), msg)
                         self.assertTrue(storage.pop_front())
 
+    def test_seek_and_replay(self):
+        with TestContext() as ctx:
+            storage = persizmq.PersistentStorage(persistent_dir=ctx.tmp_dir, index_interval=2)
+
+            timestamps = []  # type: List[float]
+            for i in range(11000, 11010):
+                timestamps.append(time.time())
+                storage.add_message("{}".format(i).encode())
+                time.sleep(0.002)
+
+            self.assertEqual(0, storage.seek(timestamp=0.0))
+            self.assertEqual(4, storage.seek(timestamp=timestamps[4]))
+            self.assertEqual(10, storage.seek(timestamp=time.time()))
+
+            replayed = [msg for _, msg in storage.replay(start=timestamps[3], end=timestamps[6])]
+            self.assertListEqual([b"11003", b"11004", b"11005"], replayed)
+
+            # Replaying does not consume the messages.
+            self.assertEqual(b"11000", storage.front())
+
+            for _ in range(5):
+                self.assertTrue(storage.pop_front())
+
+            # simulate a restart
+            storage = persizmq.PersistentStorage(persistent_dir=ctx.tmp_dir, index_interval=2)
+            self.assertEqual(5, storage.seek(timestamp=0.0))
+            self.assertEqual(7, storage.seek(timestamp=timestamps[7]))
+
+            replayed_with_times = list(storage.replay(start=timestamps[8]))
+            self.assertListEqual([b"11008", b"11009"], [msg for _, msg in replayed_with_times])
+            self.assertGreaterEqual(replayed_with_times[0][0], timestamps[8])
+
+    def test_seek_and_replay_after_drain(self):
+        with TestContext() as ctx:
+            storage = persizmq.PersistentStorage(persistent_dir=ctx.tmp_dir, index_interval=2)
+            for i in range(11100, 11110):
+                storage.add_message("{}".format(i).encode())
+            while storage.pop_front():
+                pass
+
+            # simulate a restart with no message files left on disk
+            storage = persizmq.PersistentStorage(persistent_dir=ctx.tmp_dir, index_interval=2)
+            start = time.time()
+            for i in range(11110, 11120):
+                storage.add_message("{}".format(i).encode())
+
+            # The sequence numbers continue after the indexed ones of the consumed messages.
+            self.assertLessEqual(8, storage.seek(timestamp=start))
+            self.assertEqual(storage.seek(timestamp=start), storage.seek(timestamp=0.0))
+
+            replayed = [msg for _, msg in storage.replay(start=start)]
+            self.assertListEqual(["{}".format(i).encode() for i in range(11110, 11120)], replayed)
+
+            # simulate another restart
+            storage = persizmq.PersistentStorage(persistent_dir=ctx.tmp_dir, index_interval=2)
+            replayed = [msg for _, msg in storage.replay(start=start)]
+            self.assertListEqual(["{}".format(i).encode() for i in range(11110, 11120)], replayed)
+
+    def test_clock_set_back(self):
+        with TestContext() as ctx:
+            storage = persizmq.PersistentStorage(persistent_dir=ctx.tmp_dir, index_interval=1)
+
+            now = time.time()
+            with unittest.mock.patch("time.time", side_effect=[now, now - 3600.0, now + 1.0]):
+                for i in range(11200, 11203):
+                    storage.add_message("{}".format(i).encode())
+
+            # The receive times do not decrease, so the message added while the clock was set back is not skipped.
+            self.assertEqual(0, storage.seek(timestamp=now))
+            replayed_with_times = list(storage.replay(start=now))
+            self.assertListEqual([b"11200", b"11201", b"11202"], [msg for _, msg in replayed_with_times])
+            self.assertListEqual([now, now, now + 1.0], [timestamp for timestamp, _ in replayed_with_times])
+
 
 class TestFilters(unittest.TestCase):
     def test_that_it_works(self):
@@ -368,6 +456,909 @@ class TestPersistentLatest(unittest.TestCase):
                     self.assertEqual(b"4019", msg)
                     self.assertFalse(persi_latest.new_message)
 
+    def test_conflate(self):
+        with TestContext() as ctx:
+            with ctx.subscriber() as subscriber:
+                persi_latest = persizmq.PersistentLatestStorage(persistent_dir=ctx.tmp_dir)
+                metrics = persizmq.metrics.Metrics()
+
+                # Publish a burst before the threaded subscriber starts listening.
+                for i in range(4100, 4200):
+                    ctx.publisher.send("{}".format(i).encode())
+                time.sleep(0.01)
+
+                persisted = []  # type: List[bytes]
+
+                def callback(msg: bytes) -> None:
+                    persisted.append(msg)
+                    persi_latest.add_message(msg)
+
+                thread_sub = persizmq.ThreadedSubscriber(
+                    callback=callback,
+                    subscriber=subscriber,
+                    on_exception=lambda exc: None,
+                    metrics=metrics,
+                    conflate=True)
+
+                with thread_sub:
+                    time.sleep(0.01)
+
+                    self.assertEqual(b"4199", persi_latest.message())
+
+                    # The whole burst has been drained at once and only the latest message has been persisted.
+                    self.assertListEqual([b"4199"], persisted)
+
+                counters = metrics.snapshot()["counters"]
+                self.assertEqual(100, counters[persizmq.metrics.RECEIVED])
+                self.assertEqual(99, counters[persizmq.metrics.CONFLATED])
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram(self):
+        histogram = persizmq.metrics.Histogram()
+        self.assertEqual(0, histogram.percentile(50.0))
+
+        for i in range(1, 1001):
+            histogram.record(seconds=i / 1e3)
+
+        self.assertEqual(1000, histogram.count)
+        self.assertEqual(1000, histogram.min)
+        self.assertEqual(1000000, histogram.max)
+
+        # The relative error is bounded by the number of sub-buckets.
+        self.assertAlmostEqual(500000, histogram.percentile(50.0), delta=500000 / 32)
+        self.assertAlmostEqual(990000, histogram.percentile(99.0), delta=990000 / 32)
+        self.assertEqual(1000000, histogram.percentile(100.0))
+
+    def test_storage(self):
+        with TestContext() as ctx:
+            with ctx.subscriber() as subscriber:
+                metrics = persizmq.metrics.Metrics()
+
+                updates = []  # type: List[str]
+                metrics.hooks.append(lambda name, value: updates.append(name))
+
+                storage = persizmq.PersistentStorage(persistent_dir=ctx.tmp_dir, metrics=metrics)
+                thread_sub = persizmq.ThreadedSubscriber(
+                    callback=lambda msg: storage.add_message(persizmq.filter.MaxSize(max_size=4)(msg)),
+                    subscriber=subscriber,
+                    on_exception=lambda exc: None,
+                    metrics=metrics)
+
+                with thread_sub:
+                    ctx.publisher.send(b"5000")
+                    ctx.publisher.send(b"too long")
+                    ctx.publisher.send(b"5001")
+                    time.sleep(0.01)
+
+                    self.assertTrue(storage.pop_front())
+
+                snapshot = metrics.snapshot()
+                self.assertDictEqual({
+                    persizmq.metrics.RECEIVED: 3,
+                    persizmq.metrics.FILTERED: 1,
+                    persizmq.metrics.PERSISTED: 2,
+                    persizmq.metrics.POPPED: 1
+                }, snapshot["counters"])
+                self.assertEqual(1, snapshot["gauges"][persizmq.metrics.QUEUE_DEPTH])
+
+                histograms = snapshot["histograms"]
+                self.assertEqual(2, histograms[persizmq.metrics.WRITE_LATENCY]["count"])
+                self.assertEqual(2, histograms[persizmq.metrics.RECV_TO_PERSIST]["count"])
+                self.assertEqual(1, histograms[persizmq.metrics.PERSIST_TO_CONSUME]["count"])
+
+                self.assertIn(persizmq.metrics.RECEIVED, updates)
+
+            # Recovered messages are counted in the queue depth, but have no persistence time.
+            metrics = persizmq.metrics.Metrics()
+            storage = persizmq.PersistentStorage(persistent_dir=ctx.tmp_dir, metrics=metrics)
+            self.assertEqual(1, metrics.snapshot()["gauges"][persizmq.metrics.QUEUE_DEPTH])
+            self.assertTrue(storage.pop_front())
+            self.assertNotIn(persizmq.metrics.PERSIST_TO_CONSUME, metrics.snapshot()["histograms"])
+
+
+class TestMultiConsumerStorage(unittest.TestCase):
+    def test_independent_cursors(self):
+        with TestContext() as ctx:
+            storage = persizmq.multiconsumer.MultiConsumerStorage(persistent_dir=ctx.tmp_dir, consumers=["a", "b"])
+            for i in range(6000, 6003):
+                storage.add_message("{}".format(i).encode())
+
+            self.assertEqual(b"6000", storage.front(consumer="a"))
+            self.assertTrue(storage.pop_front(consumer="a"))
+            self.assertTrue(storage.pop_front(consumer="a"))
+            self.assertEqual(b"6002", storage.front(consumer="a"))
+
+            # Consumer "b" has not read anything so far, so no message has been deleted.
+            self.assertEqual(3, len(list(ctx.tmp_dir.glob("*.bin"))))
+            self.assertEqual(b"6000", storage.front(consumer="b"))
+            self.assertTrue(storage.pop_front(consumer="b"))
+            self.assertEqual(2, len(list(ctx.tmp_dir.glob("*.bin"))))
+
+            # simulate a restart
+            storage = persizmq.multiconsumer.MultiConsumerStorage(persistent_dir=ctx.tmp_dir, consumers=["a", "c"])
+            self.assertListEqual(["a", "b", "c"], storage.consumers())
+            self.assertEqual(b"6002", storage.front(consumer="a"))
+            self.assertEqual(b"6001", storage.front(consumer="b"))
+            self.assertEqual(b"6001", storage.front(consumer="c"))
+
+            storage.remove_consumer(consumer="b")
+            storage.remove_consumer(consumer="c")
+            self.assertEqual(1, len(list(ctx.tmp_dir.glob("*.bin"))))
+
+            self.assertTrue(storage.pop_front(consumer="a"))
+            self.assertIsNone(storage.front(consumer="a"))
+            self.assertFalse(storage.pop_front(consumer="a"))
+            self.assertEqual(0, len(list(ctx.tmp_dir.glob("*.bin"))))
+
+            with self.assertRaises(KeyError):
+                storage.front(consumer="b")
+
+    def test_restart_after_drain(self):
+        with TestContext() as ctx:
+            storage = persizmq.multiconsumer.MultiConsumerStorage(persistent_dir=ctx.tmp_dir, consumers=["a"])
+            for i in range(6200, 6205):
+                storage.add_message("{}".format(i).encode())
+
+            # The cursor file is overwritten in place rather than replaced.
+            cursor_pth = ctx.tmp_dir / "cursors" / "a.cursor"
+            inode = cursor_pth.stat().st_ino
+            while storage.pop_front(consumer="a"):
+                pass
+            self.assertEqual(inode, cursor_pth.stat().st_ino)
+            self.assertEqual(8, cursor_pth.stat().st_size)
+            self.assertEqual(0, len(list(ctx.tmp_dir.glob("*.bin"))))
+
+            # simulate a restart with no message files left on disk
+            storage = persizmq.multiconsumer.MultiConsumerStorage(persistent_dir=ctx.tmp_dir, consumers=["a"])
+            self.assertIsNone(storage.front(consumer="a"))
+            storage.add_message(b"6205")
+
+            # simulate another restart
+            storage = persizmq.multiconsumer.MultiConsumerStorage(persistent_dir=ctx.tmp_dir, consumers=["a"])
+            self.assertEqual(b"6205", storage.front(consumer="a"))
+            self.assertTrue(storage.pop_front(consumer="a"))
+            self.assertIsNone(storage.front(consumer="a"))
+
+    def test_with_threaded_subscriber(self):
+        with TestContext() as ctx:
+            with ctx.subscriber() as subscriber:
+                storage = persizmq.multiconsumer.MultiConsumerStorage(persistent_dir=ctx.tmp_dir, consumers=["a", "b"])
+                thread_sub = persizmq.ThreadedSubscriber(
+                    callback=storage.add_message, subscriber=subscriber, on_exception=lambda exc: None)
+
+                with thread_sub:
+                    ctx.publisher.send(b"6100")
+                    time.sleep(0.01)
+
+                    for consumer in ["a", "b"]:
+                        self.assertEqual(b"6100", storage.front(consumer=consumer))
+                        self.assertTrue(storage.pop_front(consumer=consumer))
+                        self.assertIsNone(storage.front(consumer=consumer))
+
+
+class TestLeasedStorage(unittest.TestCase):
+    def test_claim_ack_nack(self):
+        with TestContext() as ctx:
+            storage = persizmq.lease.LeasedStorage(persistent_dir=ctx.tmp_dir)
+            for i in range(7000, 7003):
+                storage.add_message("{}".format(i).encode())
+
+            # Concurrent claims receive distinct messages.
+            first = storage.claim()
+            second = storage.claim()
+            third = storage.claim()
+            assert first is not None and second is not None and third is not None
+            self.assertListEqual([b"7000", b"7001", b"7002"], [first[1], second[1], third[1]])
+            self.assertIsNone(storage.claim())
+
+            self.assertTrue(storage.ack(first[0]))
+            self.assertFalse(storage.ack(first[0]))
+            self.assertTrue(storage.nack(second[0]))
+
+            redelivered = storage.claim()
+            assert redelivered is not None
+            self.assertEqual(b"7001", redelivered[1])
+            self.assertEqual(2, storage.pending())
+
+            # The directory is locked against a second instance.
+            with self.assertRaises(RuntimeError):
+                persizmq.lease.LeasedStorage(persistent_dir=ctx.tmp_dir)
+
+            # simulate a restart; the leases are lost and the messages are available again.
+            storage.close()
+            with persizmq.lease.LeasedStorage(persistent_dir=ctx.tmp_dir) as storage:
+                claimed = storage.claim()
+                assert claimed is not None
+                self.assertEqual(b"7001", claimed[1])
+
+    def test_lease_timeout(self):
+        with TestContext() as ctx:
+            storage = persizmq.lease.LeasedStorage(persistent_dir=ctx.tmp_dir, lease_timeout=0.01)
+            storage.add_message(b"7100")
+
+            claimed = storage.claim()
+            assert claimed is not None
+            self.assertIsNone(storage.claim())
+
+            time.sleep(0.02)
+
+            redelivered = storage.claim()
+            assert redelivered is not None
+            self.assertEqual(b"7100", redelivered[1])
+
+            # The expired lease can not be acknowledged any more.
+            self.assertFalse(storage.ack(claimed[0]))
+            self.assertTrue(storage.ack(redelivered[0]))
+            self.assertEqual(0, storage.pending())
+
+    def test_expired_lease_without_claim(self):
+        with TestContext() as ctx:
+            storage = persizmq.lease.LeasedStorage(persistent_dir=ctx.tmp_dir, lease_timeout=0.01)
+            storage.add_message(b"7200")
+            storage.add_message(b"7201")
+
+            first = storage.claim()
+            second = storage.claim()
+            assert first is not None and second is not None
+
+            time.sleep(0.05)
+
+            # No claim in between, the leases have expired nevertheless.
+            self.assertFalse(storage.ack(first[0]))
+            self.assertFalse(storage.nack(second[0]))
+            self.assertEqual(2, storage.pending())
+
+            redelivered = storage.claim()
+            assert redelivered is not None
+            self.assertEqual(b"7200", redelivered[1])
+
+
+def produce_shared(persistent_dir: pathlib.Path, start: int, count: int) -> None:
+    with persizmq.shared.SharedStorage(persistent_dir=persistent_dir) as storage:
+        for i in range(start, start + count):
+            storage.add_message("{}".format(i).encode())
+
+
+class TestSharedStorage(unittest.TestCase):
+    def test_two_instances(self):
+        with TestContext() as ctx:
+            with persizmq.shared.SharedStorage(persistent_dir=ctx.tmp_dir) as producer, \
+                    persizmq.shared.SharedStorage(persistent_dir=ctx.tmp_dir) as consumer:
+                self.assertIsNone(consumer.front())
+                self.assertFalse(consumer.pop_front())
+
+                producer.add_message(b"8000")
+                producer.add_message(b"8001")
+
+                self.assertEqual(2, consumer.size())
+                self.assertEqual(b"8000", consumer.front())
+                self.assertTrue(producer.pop_front())
+                self.assertEqual(b"8001", consumer.front())
+                self.assertEqual(b"8001", consumer.pop())
+                self.assertIsNone(producer.pop())
+
+                producer.add_message(b"8002")
+
+            # simulate a restart
+            with persizmq.shared.SharedStorage(persistent_dir=ctx.tmp_dir) as storage:
+                self.assertEqual(b"8002", storage.pop())
+                self.assertEqual(0, len(list(ctx.tmp_dir.glob("*.bin"))))
+
+    def test_multiple_processes(self):
+        with TestContext() as ctx:
+            procs = [
+                multiprocessing.Process(target=produce_shared, args=(ctx.tmp_dir, start, 50))
+                for start in [8100, 8200, 8300]
+            ]
+            for proc in procs:
+                proc.start()
+
+            received = []  # type: List[bytes]
+            with persizmq.shared.SharedStorage(persistent_dir=ctx.tmp_dir) as storage:
+                for proc in procs:
+                    proc.join()
+
+                while True:
+                    msg = storage.pop()
+                    if msg is None:
+                        break
+                    received.append(msg)
+
+            expected = ["{}".format(i).encode() for start in [8100, 8200, 8300] for i in range(start, start + 50)]
+            self.assertListEqual(sorted(expected), sorted(received))
+
+            # The order of the messages of each producer is kept.
+            for start in [8100, 8200, 8300]:
+                from_producer = [msg for msg in received if int(msg) // 100 * 100 == start]
+                self.assertListEqual(sorted(from_producer), from_producer)
+
+    def test_orphaned_message(self):
+        with TestContext() as ctx:
+            with persizmq.shared.SharedStorage(persistent_dir=ctx.tmp_dir) as storage:
+                storage.add_message(b"8400")
+                storage.add_message(b"8401")
+
+            # simulate a crash after the head has been advanced, but before the file has been removed
+            orphan = ctx.tmp_dir / "{:030d}.bin".format(0)
+            orphan_data = orphan.read_bytes()
+            with persizmq.shared.SharedStorage(persistent_dir=ctx.tmp_dir) as storage:
+                self.assertTrue(storage.pop_front())
+            orphan.write_bytes(orphan_data)
+
+            with persizmq.shared.SharedStorage(persistent_dir=ctx.tmp_dir) as storage:
+                self.assertFalse(orphan.exists())
+                self.assertEqual(1, storage.size())
+                self.assertEqual(b"8401", storage.front())
+
+
+class TestCodec(unittest.TestCase):
+    def test_round_trip(self):
+        obj = {"some": [1, 2.5, "text", None]}
+        for codec in [persizmq.codec.Json(), persizmq.codec.Pickle()]:
+            self.assertEqual(obj, codec.decode(codec.encode(obj)))
+
+        self.assertEqual(b"9000", persizmq.codec.Raw().decode(persizmq.codec.Raw().encode(b"9000")))
+        with self.assertRaises(TypeError):
+            persizmq.codec.Raw().encode("9000")
+
+    def test_incomplete_codec(self):
+        class EncodeOnly(persizmq.codec.Codec):  # pylint: disable=abstract-method
+            def encode(self, obj: object) -> bytes:
+                return b""
+
+        with self.assertRaises(TypeError):
+            EncodeOnly()  # type: ignore  # pylint: disable=abstract-class-instantiated
+
+    def test_threaded_subscriber(self):
+        with TestContext() as ctx:
+            with ctx.subscriber() as subscriber:
+                received = []  # type: List[object]
+                thread_sub = persizmq.ThreadedSubscriber(
+                    callback=received.append,
+                    subscriber=subscriber,
+                    on_exception=lambda exc: None,
+                    codec=persizmq.codec.Json())
+
+                with thread_sub:
+                    ctx.publisher.send(persizmq.codec.Json().encode({"id": 9100}))
+                    time.sleep(0.01)
+
+                    self.assertListEqual([{"id": 9100}], received)
+
+    def test_storages(self):
+        with TestContext() as ctx:
+            storage = persizmq.PersistentStorage(persistent_dir=ctx.tmp_dir / "storage", codec=persizmq.codec.Json())
+            self.assertIsNone(storage.front_object())
+
+            storage.add_object({"id": 9200})
+            storage.add_object({"id": 9201})
+
+            # The first message is decoded only once.
+            first = storage.front_object()
+            self.assertEqual({"id": 9200}, first)
+            self.assertIs(first, storage.front_object())
+            self.assertTrue(storage.pop_front())
+            self.assertEqual({"id": 9201}, storage.front_object())
+
+            latest = persizmq.PersistentLatestStorage(
+                persistent_dir=ctx.tmp_dir / "latest", codec=persizmq.codec.Json())
+            self.assertIsNone(latest.message_object())
+            latest.add_object([9300])
+            self.assertTrue(latest.new_message)
+            self.assertEqual([9300], latest.message_object())
+            self.assertFalse(latest.new_message)
+
+            multi = persizmq.multiconsumer.MultiConsumerStorage(
+                persistent_dir=ctx.tmp_dir / "multi", consumers=["a", "b"], codec=persizmq.codec.Json())
+            multi.add_object({"id": 9400})
+
+            # The consumers at the same position share the decoded message.
+            self.assertIs(multi.front_object(consumer="a"), multi.front_object(consumer="b"))
+            self.assertTrue(multi.pop_front(consumer="a"))
+            self.assertIsNone(multi.front_object(consumer="a"))
+            self.assertEqual({"id": 9400}, multi.front_object(consumer="b"))
+
+            without_codec = persizmq.PersistentStorage(persistent_dir=ctx.tmp_dir / "without_codec")
+            with self.assertRaises(ValueError):
+                without_codec.front_object()
+
+    def test_leased_and_shared_storages(self):
+        with TestContext() as ctx:
+            with persizmq.lease.LeasedStorage(persistent_dir=ctx.tmp_dir / "leased",
+                                              codec=persizmq.codec.Json()) as leased:
+                self.assertIsNone(leased.claim_object())
+                leased.add_object({"id": 9500})
+
+                claimed = leased.claim_object()
+                assert claimed is not None
+                lease, obj = claimed
+                self.assertEqual({"id": 9500}, obj)
+                self.assertTrue(leased.ack(lease=lease))
+
+            with persizmq.shared.SharedStorage(persistent_dir=ctx.tmp_dir / "shared",
+                                               codec=persizmq.codec.Json()) as shared:
+                self.assertIsNone(shared.front_object())
+                shared.add_object({"id": 9600})
+                shared.add_object({"id": 9601})
+
+                first = shared.front_object()
+                self.assertEqual({"id": 9600}, first)
+                self.assertIs(first, shared.front_object())
+
+                self.assertEqual({"id": 9600}, shared.pop_object())
+                self.assertEqual({"id": 9601}, shared.front_object())
+                self.assertEqual({"id": 9601}, shared.pop_object())
+                self.assertIsNone(shared.pop_object())
+
+            with persizmq.shared.SharedStorage(persistent_dir=ctx.tmp_dir / "shared_without_codec") as shared:
+                with self.assertRaises(ValueError):
+                    shared.pop_object()
+
+
+class TestPersistentPublisher(unittest.TestCase):
+    def test_store_and_forward(self):
+        with TestContext() as ctx:
+            url = "inproc://persizmq_test_push" + str(uuid.uuid4())
+            outbox_dir = ctx.tmp_dir / "outbox"
+
+            with ctx.context.socket(zmq.PUSH) as push:  # pylint: disable=no-member
+                push.bind(url)
+
+                # Nobody is connected, so the messages wait in the outbox.
+                publisher = persizmq.publisher.PersistentPublisher(
+                    publisher=push,
+                    outbox=persizmq.PersistentStorage(persistent_dir=outbox_dir),
+                    on_exception=lambda exc: None)
+                with publisher:
+                    publisher.send(b"10000")
+                    publisher.send(None)
+                    publisher.send(b"10001")
+                    self.assertFalse(publisher.flush(timeout=0.05))
+
+                # simulate a restart
+                with ctx.context.socket(zmq.PULL) as pull:  # pylint: disable=no-member
+                    pull.connect(url)
+
+                    publisher = persizmq.publisher.PersistentPublisher(
+                        publisher=push,
+                        outbox=persizmq.PersistentStorage(persistent_dir=outbox_dir),
+                        on_exception=lambda exc: None)
+                    with publisher:
+                        publisher.send(b"10002")
+                        self.assertTrue(publisher.flush(timeout=1.0))
+
+                    received = [pull.recv() for _ in range(3)]
+                    self.assertListEqual([b"10000", b"10001", b"10002"], received)
+                    self.assertEqual(0, len(list(outbox_dir.glob("*.bin"))))
+
+    def test_flush_after_failure(self):
+        class FailingOutbox(persizmq.PersistentStorage):
+            def front(self) -> Optional[bytes]:
+                if threading.current_thread() is not threading.main_thread():
+                    raise RuntimeError("some failure in the sending thread")
+
+                return super().front()
+
+        with TestContext() as ctx:
+            with ctx.context.socket(zmq.PUSH) as push:  # pylint: disable=no-member
+                push.bind("inproc://persizmq_test_push" + str(uuid.uuid4()))
+
+                errors = []  # type: List[Exception]
+                publisher = persizmq.publisher.PersistentPublisher(
+                    publisher=push, outbox=FailingOutbox(persistent_dir=ctx.tmp_dir), on_exception=errors.append)
+                with publisher:
+                    publisher.send(b"10100")
+
+                    # The sending thread stopped, so the flush must not wait for the timeout.
+                    start = time.monotonic()
+                    self.assertFalse(publisher.flush(timeout=5.0))
+                    self.assertLess(time.monotonic() - start, 1.0)
+                    self.assertEqual(1, len(errors))
+
+                # The flush after the shutdown returns immediately as well.
+                self.assertFalse(publisher.flush())
+
+
+class TestHybridStorage(unittest.TestCase):
+    def test_memory_and_spill(self):
+        with TestContext() as ctx:
+            with persizmq.hybrid.HybridStorage(persistent_dir=ctx.tmp_dir, memory_capacity=2, max_lag=None) as storage:
+                # A fast consumer is served from memory.
+                storage.add_message(b"12000")
+                storage.add_message(b"12001")
+                self.assertEqual(2, storage.buffered())
+                self.assertEqual(0, len(list(ctx.tmp_dir.glob("*.bin"))))
+
+                self.assertEqual(b"12000", storage.front())
+                self.assertTrue(storage.pop_front())
+
+                # The buffer overflows and is spilled to disk.
+                storage.add_message(b"12002")
+                storage.add_message(b"12003")
+                self.assertEqual(0, storage.buffered())
+                self.assertEqual(3, len(list(ctx.tmp_dir.glob("*.bin"))))
+
+                storage.add_message(b"12004")
+                self.assertEqual(1, storage.buffered())
+
+            # The buffer is flushed when leaving the context; simulate a restart.
+            with persizmq.hybrid.HybridStorage(persistent_dir=ctx.tmp_dir) as storage:
+                received = []  # type: List[bytes]
+                while True:
+                    msg = storage.front()
+                    if msg is None:
+                        break
+                    received.append(msg)
+                    self.assertTrue(storage.pop_front())
+
+                self.assertListEqual([b"12001", b"12002", b"12003", b"12004"], received)
+                self.assertFalse(storage.pop_front())
+
+    def test_max_lag(self):
+        with TestContext() as ctx:
+            with persizmq.hybrid.HybridStorage(persistent_dir=ctx.tmp_dir, max_lag=0.01) as storage:
+                storage.add_message(b"12100")
+                self.assertEqual(1, storage.buffered())
+
+                # The consumer fell behind, so the buffered message is spilled even though there is no traffic.
+                deadline = time.monotonic() + 1.0
+                while storage.buffered() > 0 and time.monotonic() < deadline:
+                    time.sleep(0.01)
+
+                self.assertEqual(0, storage.buffered())
+                self.assertEqual(1, len(list(ctx.tmp_dir.glob("*.bin"))))
+
+                storage.add_message(b"12101")
+                self.assertEqual(1, storage.buffered())
+                self.assertEqual(b"12100", storage.front())
+
+    def test_failed_spill_without_traffic(self):
+        with TestContext() as ctx:
+            with persizmq.hybrid.HybridStorage(persistent_dir=ctx.tmp_dir, max_lag=0.05) as storage:
+                with unittest.mock.patch.object(
+                        persizmq.PersistentStorage, "add_message", side_effect=OSError("disk full")) as add_message:
+                    storage.add_message(b"12200")
+                    time.sleep(0.3)
+
+                    # The lag thread retries only every max_lag instead of spinning on the failure.
+                    self.assertLessEqual(add_message.call_count, 7)
+                    self.assertEqual(1, storage.buffered())
+
+                # The failure is reported to the caller even though nothing has been added or popped meanwhile.
+                with self.assertRaises(OSError):
+                    storage.add_message(b"12201")
+
+                storage.add_message(b"12201")
+                storage.flush()
+                self.assertEqual(2, len(list(ctx.tmp_dir.glob("*.bin"))))
+
+
+class TestShardedStorage(unittest.TestCase):
+    def test_fifo_across_shards(self):
+        with TestContext() as ctx:
+            shard_dirs = [ctx.tmp_dir / "shard0", ctx.tmp_dir / "shard1", ctx.tmp_dir / "shard2"]
+
+            with persizmq.sharded.ShardedStorage(persistent_dirs=shard_dirs) as storage:
+                for i in range(13000, 13010):
+                    storage.add_message("{}".format(i).encode())
+                storage.add_message(None)
+
+                self.assertTrue(storage.flush(timeout=1.0))
+
+                # The messages are striped across the shards.
+                self.assertListEqual([4, 3, 3], [len(list(shard_dir.glob("*.bin"))) for shard_dir in shard_dirs])
+
+                self.assertEqual(b"13000", storage.front())
+                self.assertTrue(storage.pop_front())
+
+            # simulate a restart with a different number of shards
+            with persizmq.sharded.ShardedStorage(persistent_dirs=shard_dirs[:2] + [ctx.tmp_dir / "shard3"]) as storage:
+                storage.add_message(b"13010")
+                self.assertTrue(storage.flush(timeout=1.0))
+
+            with persizmq.sharded.ShardedStorage(persistent_dirs=shard_dirs + [ctx.tmp_dir / "shard3"]) as storage:
+                received = []  # type: List[bytes]
+                while True:
+                    msg = storage.front()
+                    if msg is None:
+                        break
+                    received.append(msg)
+                    self.assertTrue(storage.pop_front())
+
+                self.assertListEqual(["{}".format(i).encode() for i in range(13001, 13011)], received)
+                self.assertFalse(storage.pop_front())
+
+    def test_restart_without_a_shard(self):
+        with TestContext() as ctx:
+            shard_dirs = [ctx.tmp_dir / "shard0", ctx.tmp_dir / "shard1", ctx.tmp_dir / "shard2"]
+
+            with persizmq.sharded.ShardedStorage(persistent_dirs=shard_dirs[:2]) as storage:
+                for i in range(13100, 13104):
+                    storage.add_message("{}".format(i).encode())
+                self.assertTrue(storage.flush(timeout=1.0))
+
+            # The left-out shard holds the message with the highest sequence number.
+            with persizmq.sharded.ShardedStorage(persistent_dirs=[shard_dirs[0], shard_dirs[2]]) as storage:
+                storage.add_message(b"13104")
+                self.assertTrue(storage.flush(timeout=1.0))
+
+            with persizmq.sharded.ShardedStorage(persistent_dirs=shard_dirs) as storage:
+                received = []  # type: List[bytes]
+                while True:
+                    msg = storage.front()
+                    if msg is None:
+                        break
+                    received.append(msg)
+                    self.assertTrue(storage.pop_front())
+
+                self.assertListEqual(["{}".format(i).encode() for i in range(13100, 13105)], received)
+
+            # A message found in two shards is reported instead of silently overwritten.
+            with persizmq.sharded.ShardedStorage(persistent_dirs=shard_dirs[:1]) as storage:
+                storage.add_message(b"13105")
+                self.assertTrue(storage.flush(timeout=1.0))
+
+            for pth in shard_dirs[0].glob("*.bin"):
+                (shard_dirs[1] / pth.name).write_bytes(pth.read_bytes())
+
+            with self.assertRaises(ValueError):
+                persizmq.sharded.ShardedStorage(persistent_dirs=shard_dirs)
+
+
+class TestPriorityStorage(unittest.TestCase):
+    def test_most_urgent_first(self):
+        with TestContext() as ctx:
+            classifier = persizmq.priority.TopicPrefix(levels={b"alarm": 0, b"alarm/test": 2, b"log": 1}, default=2)
+
+            storage = persizmq.priority.PriorityStorage(persistent_dir=ctx.tmp_dir, levels=3, classifier=classifier)
+            for msg in [b"other 1", b"log 1", b"alarm/test 1", b"alarm 1", b"log 2", b"alarm 2"]:
+                storage.add_message(msg)
+            storage.add_message(None)
+
+            self.assertEqual(6, storage.size())
+            self.assertEqual(2, storage.size(level=0))
+            self.assertEqual(2, storage.size(level=2))
+
+            self.assertEqual(b"alarm 1", storage.front())
+            self.assertTrue(storage.pop_front())
+
+            # simulate a restart
+            storage = persizmq.priority.PriorityStorage(persistent_dir=ctx.tmp_dir, levels=3, classifier=classifier)
+            storage.add_message(b"alarm 3")
+
+            received = []  # type: List[bytes]
+            while True:
+                msg = storage.front()
+                if msg is None:
+                    break
+                received.append(msg)
+                self.assertTrue(storage.pop_front())
+
+            self.assertListEqual([b"alarm 2", b"alarm 3", b"log 1", b"log 2", b"other 1", b"alarm/test 1"], received)
+            self.assertFalse(storage.pop_front())
+
+    def test_urgent_message_between_front_and_pop(self):
+        with TestContext() as ctx:
+            classifier = persizmq.priority.TopicPrefix(levels={b"alarm": 0}, default=1)
+            storage = persizmq.priority.PriorityStorage(persistent_dir=ctx.tmp_dir, levels=2, classifier=classifier)
+
+            storage.add_message(b"bulk 1")
+            self.assertEqual(b"bulk 1", storage.front())
+
+            # The alarm arrives after the front, so the pop must remove the bulk message, not the unread alarm.
+            storage.add_message(b"alarm 1")
+            self.assertTrue(storage.pop_front())
+            self.assertEqual(b"alarm 1", storage.front())
+
+            storage.add_message(b"bulk 2")
+            self.assertEqual(b"alarm 1", storage.pop())
+            self.assertEqual(b"bulk 2", storage.pop())
+            self.assertIsNone(storage.pop())
+            self.assertFalse(storage.pop_front())
+
+    def test_invalid_level(self):
+        with TestContext() as ctx:
+            storage = persizmq.priority.PriorityStorage(
+                persistent_dir=ctx.tmp_dir, levels=2, classifier=len)
+
+            storage.add_message(b"x")
+            with self.assertRaises(ValueError):
+                storage.add_message(b"xyz")
+
+            self.assertEqual(1, storage.size())
+
+
+class TestRetention(unittest.TestCase):
+    def test_expire(self):
+        with TestContext() as ctx:
+            storage = persizmq.PersistentStorage(persistent_dir=ctx.tmp_dir)
+            for i in range(14000, 14005):
+                storage.add_message("{}".format(i).encode())
+
+            self.assertEqual(25, storage.total_bytes())
+
+            # Keep at most three messages.
+            self.assertEqual(2, storage.expire(max_bytes=15))
+            self.assertEqual(15, storage.total_bytes())
+            self.assertEqual(b"14002", storage.front())
+            self.assertEqual(3, len(list(ctx.tmp_dir.glob("*.bin"))))
+
+            self.assertEqual(0, storage.expire(max_age=60.0))
+
+            time.sleep(0.02)
+            storage.add_message(b"14005")
+            self.assertEqual(3, storage.expire(max_age=0.01))
+            self.assertEqual(b"14005", storage.front())
+
+            # simulate a restart
+            storage = persizmq.PersistentStorage(persistent_dir=ctx.tmp_dir)
+            self.assertEqual(5, storage.total_bytes())
+            self.assertTrue(storage.pop_front())
+            self.assertEqual(0, storage.total_bytes())
+
+    def test_janitor(self):
+        with TestContext() as ctx:
+            storage = persizmq.PersistentStorage(persistent_dir=ctx.tmp_dir)
+            with persizmq.retention.Janitor(
+                    storage=storage, on_exception=lambda exc: None, max_age=0.01, period=0.005):
+                storage.add_message(b"14100")
+                time.sleep(0.05)
+
+                self.assertIsNone(storage.front())
+                self.assertEqual(0, len(list(ctx.tmp_dir.glob("*.bin"))))
+
+
+class SlowStorage(persizmq.PersistentStorage):
+    def add_messages(self, msgs: Sequence[Optional[bytes]]) -> None:
+        time.sleep(0.01)
+        super().add_messages(msgs=msgs)
+
+
+def drain(storage: persizmq.PersistentStorage) -> List[bytes]:
+    msgs = []  # type: List[bytes]
+    while True:
+        msg = storage.front()
+        if msg is None:
+            break
+        msgs.append(msg)
+        storage.pop_front()
+    return msgs
+
+
+class TestAsyncWriter(unittest.TestCase):
+    def test_block(self):
+        with TestContext() as ctx:
+            with ctx.subscriber() as subscriber:
+                storage = persizmq.PersistentStorage(persistent_dir=ctx.tmp_dir)
+                with persizmq.writer.AsyncWriter(storage=storage, on_exception=lambda exc: None) as writer:
+                    thread_sub = persizmq.ThreadedSubscriber(
+                        callback=writer.add_message, subscriber=subscriber, on_exception=lambda exc: None)
+
+                    with thread_sub:
+                        for i in range(15000, 15010):
+                            ctx.publisher.send("{}".format(i).encode())
+                        time.sleep(0.01)
+
+                    self.assertTrue(writer.flush(timeout=1.0))
+                    self.assertListEqual(["{}".format(i).encode() for i in range(15000, 15010)], drain(storage))
+
+    def test_recv_to_persist(self):
+        with TestContext() as ctx:
+            with ctx.subscriber() as subscriber:
+                metrics = persizmq.metrics.Metrics()
+                storage = persizmq.PersistentStorage(persistent_dir=ctx.tmp_dir, metrics=metrics)
+                with persizmq.writer.AsyncWriter(storage=storage, on_exception=lambda exc: None,
+                                                 metrics=metrics) as writer:
+                    thread_sub = persizmq.ThreadedSubscriber(
+                        callback=writer.add_message, subscriber=subscriber, on_exception=lambda exc: None,
+                        metrics=metrics)
+
+                    with thread_sub:
+                        ctx.publisher.send(b"15050")
+                        ctx.publisher.send(b"15051")
+                        time.sleep(0.01)
+
+                    self.assertTrue(writer.flush(timeout=1.0))
+
+                # The reception time is carried over to the writer thread.
+                histograms = metrics.snapshot()["histograms"]
+                self.assertEqual(2, histograms[persizmq.metrics.RECV_TO_PERSIST]["count"])
+
+    def test_drop(self):
+        with TestContext() as ctx:
+            storage = SlowStorage(persistent_dir=ctx.tmp_dir)
+            metrics = persizmq.metrics.Metrics()
+            with persizmq.writer.AsyncWriter(
+                    storage=storage,
+                    on_exception=lambda exc: None,
+                    queue_size=1,
+                    when_full=persizmq.writer.DROP,
+                    metrics=metrics) as writer:
+                for i in range(15100, 15110):
+                    writer.add_message("{}".format(i).encode())
+
+                self.assertTrue(writer.flush(timeout=1.0))
+
+            received = drain(storage)
+            dropped = metrics.snapshot()["counters"][persizmq.metrics.DROPPED]
+            self.assertGreater(dropped, 0)
+            self.assertEqual(10, len(received) + dropped)
+            self.assertListEqual(sorted(received), received)
+
+    def test_spill(self):
+        with TestContext() as ctx:
+            storage = SlowStorage(persistent_dir=ctx.tmp_dir / "storage")
+            metrics = persizmq.metrics.Metrics()
+            with persizmq.writer.AsyncWriter(
+                    storage=storage,
+                    on_exception=lambda exc: None,
+                    queue_size=1,
+                    when_full=persizmq.writer.SPILL,
+                    spill_dir=ctx.tmp_dir / "spill",
+                    max_batch=2,
+                    metrics=metrics) as writer:
+                for i in range(15200, 15220):
+                    writer.add_message("{}".format(i).encode())
+
+                self.assertTrue(writer.flush(timeout=1.0))
+
+            self.assertGreater(metrics.snapshot()["counters"][persizmq.metrics.SPILLED], 0)
+            self.assertListEqual(["{}".format(i).encode() for i in range(15200, 15220)], drain(storage))
+
+    def test_spill_rotation_failure(self):
+        with TestContext() as ctx:
+            spill_dir = ctx.tmp_dir / "spill"
+            errors = []  # type: List[Exception]
+            writer = persizmq.writer.AsyncWriter(
+                storage=SlowStorage(persistent_dir=ctx.tmp_dir / "storage"),
+                on_exception=errors.append,
+                queue_size=1,
+                when_full=persizmq.writer.SPILL,
+                spill_dir=spill_dir)
+
+            # The spill log can not be renamed onto a non-empty directory.
+            (spill_dir / "spill.draining").mkdir()
+            (spill_dir / "spill.draining" / "blocker").write_bytes(b"")
+
+            for i in range(15250, 15260):
+                writer.add_message("{}".format(i).encode())
+
+            self.assertFalse(writer.flush(timeout=5.0))
+            self.assertFalse(writer.operational)
+            self.assertEqual(1, len(errors))
+            self.assertIsInstance(errors[0], OSError)
+            writer.shutdown()
+
+    def test_spill_recovery(self):
+        with TestContext() as ctx:
+            spill_dir = ctx.tmp_dir / "spill"
+            spill_dir.mkdir()
+
+            # simulate a crash while the messages were spilled; the last record has been written only partially.
+            records = [struct.pack("<I", 5) + b"15300", struct.pack("<I", 5) + b"15301", struct.pack("<I", 5) + b"153"]
+            (spill_dir / "spill.log").write_bytes(b"".join(records))
+
+            storage = persizmq.PersistentStorage(persistent_dir=ctx.tmp_dir / "storage")
+            with persizmq.writer.AsyncWriter(storage=storage, on_exception=lambda exc: None, spill_dir=spill_dir):
+                self.assertListEqual([b"15300", b"15301"], drain(storage))
+                self.assertFalse((spill_dir / "spill.log").exists())
+
+    def test_drain_progress_recovery(self):
+        with TestContext() as ctx:
+            spill_dir = ctx.tmp_dir / "spill"
+            spill_dir.mkdir()
+
+            # simulate a crash while the spill log was moved to the storage; the first two messages had been moved.
+            records = [struct.pack("<I", 5) + "{}".format(i).encode() for i in range(15400, 15405)]
+            (spill_dir / "spill.draining").write_bytes(b"".join(records))
+            (spill_dir / "spill.progress").write_text("2")
+
+            storage = persizmq.PersistentStorage(persistent_dir=ctx.tmp_dir / "storage")
+            with persizmq.writer.AsyncWriter(storage=storage, on_exception=lambda exc: None, spill_dir=spill_dir):
+                self.assertListEqual([b"15402", b"15403", b"15404"], drain(storage))
+                self.assertListEqual([], list(spill_dir.iterdir()))
+
 
 if __name__ == '__main__':
     unittest.main()